@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks that the numba kernels of lcmodel give the same results as the NumPy kernels
+
+Usage: python check_kernels.py
+Exits with status 1 if any kernel differs, prints a note and exits 0 without numba
+"""
+
+import sys
+
+import numpy
+from scipy import ndimage
+
+import lcmodel
+
+
+# Random rasters with classes 0..nclasses-1, smoothed or not, including small and empty shapes
+def f_returnTestRasters(seed=42):
+    rng = numpy.random.default_rng(seed)
+    rasters = [numpy.zeros((0, 0), dtype=numpy.int32), numpy.zeros((1, 1), dtype=numpy.int32),
+               numpy.ones((1, 17), dtype=numpy.int32), numpy.ones((13, 1), dtype=numpy.int32)]
+    for h, w, nclasses in ((5, 7, 2), (64, 48, 3), (101, 77, 5), (200, 160, 4)):
+        rasters.append(rng.integers(0, nclasses, (h, w)).astype(numpy.int32))
+        smooth = ndimage.uniform_filter(rng.random((h, w)), 5)
+        rasters.append(numpy.digitize(smooth, numpy.linspace(smooth.min(), smooth.max(), nclasses + 1)[1:-1])
+                       .astype(numpy.int32))
+    return rasters
+
+
+def f_compare(name, numpy_result, numba_result):
+    if isinstance(numpy_result, tuple):
+        same = all(numpy.array_equal(a, b) for a, b in zip(numpy_result, numba_result))
+    else:
+        same = numpy.array_equal(numpy_result, numba_result)
+    if not same:
+        print("error: {} differs between the NumPy and numba kernels".format(name))
+    return same
+
+
+def f_checkKernels():
+    ok = True
+    for k, array in enumerate(f_returnTestRasters()):
+        classes = numpy.unique(array)
+        class_index = lcmodel.f_returnClassIndex(array, classes)
+        valid = array != 0
+        for s in (1, 2):
+            struct = ndimage.generate_binary_structure(2, s)
+            labeled, numpatches = ndimage.label(valid, struct) if array.size else (array.copy(), 0)
+            ok &= f_compare("edge counts (raster {}, s={})".format(k, s),
+                            lcmodel.f_edgeCountsNumpy(labeled, numpatches),
+                            lcmodel.f_edgeCountsNumba(labeled, numpatches))
+            ok &= f_compare("adjacency (raster {}, s={})".format(k, s),
+                            lcmodel.f_adjacencyNumpy(class_index, len(classes), s),
+                            lcmodel.f_adjacencyNumba(class_index, len(classes), s))
+            ok &= f_compare("same value labeling (raster {}, s={})".format(k, s),
+                            lcmodel.f_labelSameValueNumpy(array, valid, s),
+                            lcmodel.f_labelSameValueNumba(array, valid, s))
+    # stacks of tiles go through the edge count dispatcher
+    stack = numpy.stack([array for array in f_returnTestRasters() if array.shape == (64, 48)]) != 0
+    for s in (1, 2):
+        labeled, numpatches, tile_of_label = lcmodel.f_labelStack(stack, s)
+        lcmodel.USE_NUMBA = False
+        expected = lcmodel.f_edgeCounts(labeled, numpatches)
+        lcmodel.USE_NUMBA = True
+        ok &= f_compare("stack edge counts (s={})".format(s), expected, lcmodel.f_edgeCounts(labeled, numpatches))
+    return ok
+
+
+if __name__ == "__main__":
+    if lcmodel.numba is None:
+        print("numba is not installed, only the NumPy kernels are available")
+        sys.exit(0)
+    if not f_checkKernels():
+        sys.exit(1)
+    print("all kernels agree")
@@ -8,6 +8,9 @@ import numpy as np
 
 import gdal, ogr
 
+# compiled (numba) or NumPy neighbour counting
+from lcmodel import f_adjacencyCounts, f_returnClassIndex
+
 rasterpath = "amz_prode_NA_utm_corrected.tif"
 
 raster = gdal.Open(str(rasterpath))
@@ -46,49 +49,13 @@ for i in range(len(classes)):
 
 print(matti)
 
-heightFP,widthFP = example_array.shape #define hight and width of input matrix
-withBorders = np.ones((heightFP+(2*1),widthFP+(2*1)), dtype=np.int8)*nodata # set the border to borderValue
-withBorders[1:heightFP+1,1:widthFP+1]=example_array # set the interior region to the input matrix
-
-for j in range(1, example_array.shape[0]):
-    for i in range(1, example_array.shape[1]):
-
-        if not withBorders[j,i] == nodata:
-            # print("withBorders[{},{}] = {}".format(j,i, withBorders[j,i]))
-            # get central val class
-            # that means x is the class for which we update neighbours stats in matti
-            # so x is the "ref_class" and neighbours a-h are "count_classes"
-            # at position matti[x,a] += 1
-            x = int( withBorders[j,i] )
-            # sample 8 neighbours
-            # a b c
-            # h x d
-            # g f e
-            a = int( withBorders[j-1,i-1] )
-            if not a == nodata:
-                matti[x,a] += 1
-            b = int( withBorders[j-1,i] )
-            if not b == nodata:
-                matti[x,b] += 1
-            c = int( withBorders[j-1,i+1] )
-            if not c == nodata:
-                matti[x,c] += 1
-            d = int( withBorders[j,i+1] )
-            if not d == nodata:
-                matti[x,d] += 1
-            e = int( withBorders[j+1,i+1] )
-            if not e == nodata:
-                matti[x,e] += 1
-            f = int( withBorders[j+1,i] )
-            if not f == nodata:
-                matti[x,f] += 1
-            g = int( withBorders[j+1,i-1] )
-            if not g == nodata:
-                matti[x,g] += 1
-            h = int( withBorders[j,i-1] )
-            if not h == nodata:
-                matti[x,h] += 1
-            # update matti ++ at all designations
+# count for every cell of a class x ("ref_class") the classes of its 8 neighbours a-h
+# ("count_classes") at position matti[x,a], cells with nodata are skipped
+# a b c
+# h x d
+# g f e
+class_index = f_returnClassIndex(example_array, classes)
+matti[1:, 1:] = f_adjacencyCounts(class_index, len(classes), s=2)
 
 print(matti)
 
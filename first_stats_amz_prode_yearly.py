@@ -18,7 +18,7 @@ import timeit
 # raster = "extract_utm.tif"
 raster = "amz_prode_NA_utm.tif"
 
-lc_calc = LC_Initialize(raster)
+lc_calc = LC_Initialize(raster, cache=True)
 
 # simple statistics
 
@@ -49,12 +49,14 @@ results_dict['class'] = []
 for smt in desired_funcs:
     results_dict[smt] = []
 
+# label all classes in one pass, every class then only selects its patches
+lc_calc.f_cclAll()
+
 for cli in lc_calc.classes:
 
     print("doing stuff for lc class {}".format(cli))
     # need to initialise cl_array and labelled_array for current class
-    lc_calc.create_cl_array_for_class(cli)
-    lc_calc.f_ccl(lc_calc.cl_array)
+    lc_calc.f_selectClass(cli)
 
     results_dict['class'].append(cli)
 
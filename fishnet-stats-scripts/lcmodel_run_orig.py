@@ -35,7 +35,7 @@ start = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 print("initialising with ... {} ... at {}".format(raster, start))
 logger.info("initialising with ... {} ... at {}".format(raster, start))
 
-lc_calc = LC_Initialize(raster)
+lc_calc = LC_Initialize(raster, cache=True)
 
 # simple statistics
 
@@ -76,6 +76,9 @@ results_dict['class'] = []
 for smt in desired_funcs:
     results_dict[smt] = []
 
+# label all classes in one pass, every class then only selects its patches
+lc_calc.f_cclAll()
+
 for cli in lc_calc.classes:
 
     print("doing stuff for lc class {}".format(cli))
@@ -83,8 +86,7 @@ for cli in lc_calc.classes:
     # need to initialise cl_array and labelled_array for current class
     print("initialising labelled array and fcc .. {}".format( datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
     logger.info("initialising labelled array and fcc .. {}".format( datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    lc_calc.create_cl_array_for_class(cli)
-    lc_calc.f_ccl(lc_calc.cl_array)
+    lc_calc.f_selectClass(cli)
 
     results_dict['class'].append(cli)
 
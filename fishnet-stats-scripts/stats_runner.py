@@ -72,7 +72,7 @@ for raster in rasterlist:
     print("initialising with ... {} ... at {}".format(raster, start))
     logger.info("initialising with ... {} ... at {}".format(raster, start))
 
-    lc_calc = LC_Initialize(raster)
+    lc_calc = LC_Initialize(raster, cache=True)
     print("doing stuff for lc class {}".format(cli))
     logger.info("doing stuff for lc class {}".format(cli))
     # need to initialise cl_array and labelled_array for current class
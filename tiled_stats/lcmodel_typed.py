@@ -20,7 +20,9 @@
 """
 
 # Import base libraries
-import sys, math
+import sys, os, math, glob, hashlib, copy, json
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Dict, Tuple, List, Tuple, Union
 from typing import NewType, Callable, Iterable
@@ -38,10 +40,33 @@ except ImportError:
 
 # import ndimage module seperately for easy access
 from scipy import ndimage
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, shortest_path, dijkstra
 
-# Import spatial for average distance
-# from scipy import spatial 
-from scipy.spatial.distance import cdist # type: ignore
+# Import spatial for nearest neighbour distance
+from scipy.spatial import cKDTree # type: ignore
+
+# Optional compiled kernels
+try:
+    import numba # type: ignore
+except ImportError:
+    numba = None
+
+# Optional chunked arrays for rasters larger than memory
+try:
+    import dask # type: ignore
+    import dask.array as da # type: ignore
+except ImportError:
+    dask = None
+    da = None
+
+# Optional Parquet export of patch tables
+try:
+    import pyarrow # type: ignore
+    import pyarrow.parquet as pq # type: ignore
+except ImportError:
+    pyarrow = None
+    pq = None
 
 # Try to import functions from osgeo
 try:
@@ -58,6 +83,28 @@ import logging
 # create logger
 logger = logging.getLogger(__name__)
 
+# Use the numba compiled kernels for edge counting, adjacency counting and same-value
+# labeling. Set to False to force the NumPy implementations
+USE_NUMBA = numba is not None
+
+# Classes covering less than this share of the raster are labeled from their cell list
+# (SparseForeground) instead of a dense mask. Set to 0 to always use the dense path
+SPARSE_DENSITY = 0.01
+
+# Dispersal distance (map units) for the connectivity indices: patches whose edges are
+# closer are linked, and a link of this length has CONNECTIVITY_PROBABILITY in the PC index
+CONNECTIVITY_DISTANCE = 1000.0
+CONNECTIVITY_PROBABILITY = 0.5
+
+# Edge influence depth and proximity search radius (map units) of the single metrics
+EDGE_DEPTH = 100.0
+PROXIMITY_RADIUS = 1000.0
+
+# Default for LC_Initialize(cache=None): keep a decoded copy of the band as .npy next to
+# the source raster and memory-map it on later runs
+ARRAY_CACHE = False
+
+
 ## CODE START ##
 # List all available landscape functions
 # All defined metrics must possess an info file in the metric_info folder
@@ -86,6 +133,17 @@ def listStatistics() -> List[str]:
     functionList.append(unicode("Landscape division"))  # Return Landscape Division Index
     functionList.append(unicode("Effective Meshsize"))  # Return Effectiv Mesh Size
     functionList.append(unicode("Splitting Index"))  # Return Splitting Index
+    functionList.append(unicode("Correlation length"))  # Area weighted mean radius of gyration
+    functionList.append(unicode("Integral index of connectivity"))  # IIC
+    functionList.append(unicode("Probability of connectivity"))  # PC
+    functionList.append(unicode("Edge influence"))  # Share of the class within EDGE_DEPTH of an edge
+    functionList.append(unicode("Mean distance to edge"))  # Mean distance of the class cells to an edge
+    functionList.append(unicode("Proximity index"))  # Mean proximity index within PROXIMITY_RADIUS
+    functionList.append(unicode("Class edge length"))  # Edges shared with other classes
+    functionList.append(unicode("Proportion of like adjacencies"))  # PLADJ
+    functionList.append(unicode("Aggregation index"))  # AI
+    functionList.append(unicode("Clumpiness index"))  # CLUMPY
+    functionList.append(unicode("Interspersion and juxtaposition"))  # IJI of the class
 
     return functionList
 
@@ -107,27 +165,164 @@ def list_simple_metrics() -> List[str]:
 
 # Prepare raster for component labeling
 def f_landcover(raster, nodata=None):
-    raster = gdal.Open(str(raster))
-    if (raster.RasterCount == 1):
-        band = raster.GetRasterBand(1)
-        if nodata == None:
-            nodata = band.GetNoDataValue()
+    reader = RasterBlockReader(raster, nodata)
+    if reader.raster.RasterCount == 1:
         try:
-            array = band.ReadAsArray()
-        except ValueError:
+            array = reader.f_readArray()
+        except (ValueError, MemoryError):
             logger.warn("error: Raster file is to big for processing. Please crop the file and try again.")
             return
-        classes = sorted(numpy.unique(array))  # get classes
-        try:
-            classes.remove(nodata)
-        except ValueError:
+        classes = reader.f_returnClasses()  # get classes
+        if reader.nodata not in reader.f_returnValueCounts():
             logger.warn("Pass: Clipped Raster has no No-data fields, therefore nothing is removed")
-            pass
         return classes, array
     else:
         logger.warn("error: Multiband Rasters not implemented yet")
 
 
+# Iterates over a band in its native block layout, yielding (xoff, yoff, array) windows
+def f_iterBlocks(band):
+    blockX, blockY = band.GetBlockSize()
+    for yoff in range(0, band.YSize, blockY):
+        ysize = min(blockY, band.YSize - yoff)
+        for xoff in range(0, band.XSize, blockX):
+            xsize = min(blockX, band.XSize - xoff)
+            yield xoff, yoff, band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+
+# Returns the distinct values of an array and their counts
+def f_countValues(array):
+    if array.dtype.kind in "ub" and array.dtype.itemsize <= 2:
+        counts = numpy.bincount(array.ravel(), minlength=2)
+        values = numpy.flatnonzero(counts)
+        return values.astype(array.dtype), counts[values]
+    return numpy.unique(array, return_counts=True)
+
+
+# Reads the first band of a raster block by block in its native block order.
+# Value counts (and with them the classes) are collected on the first full pass, so
+# consumers that only need counts never hold more than one block in memory
+# raster_path can also be an already opened gdal.Dataset
+class RasterBlockReader():
+    def __init__(self, raster_path, nodata=None):
+        if hasattr(raster_path, "GetRasterBand"):
+            self.raster = raster_path
+            self.raster_path = raster_path.GetDescription()
+        else:
+            self.raster = gdal.Open(str(raster_path))
+            self.raster_path = raster_path
+        self.band = self.raster.GetRasterBand(1)
+        self.nodata = self.band.GetNoDataValue() if nodata is None else nodata
+        gt = self.raster.GetGeoTransform()
+        self.geotransform = gt
+        self.cellsize = gt[1]
+        self.shape = (self.band.YSize, self.band.XSize)
+        self._dense = None
+        self._sparse = {}
+        self.counted = False
+
+    def f_iterBlocks(self):
+        return f_iterBlocks(self.band)
+
+    # Adds the values of one block to the running value counts
+    def f_addBlockCounts(self, block):
+        if block.dtype.kind in "ub" and block.dtype.itemsize <= 2:
+            nbins = 1 << (8 * block.dtype.itemsize)
+            if self._dense is None:
+                self._dense = numpy.zeros(nbins, dtype=numpy.int64)
+            self._dense += numpy.bincount(block.ravel(), minlength=nbins)
+        else:
+            values, counts = numpy.unique(block, return_counts=True)
+            for v, c in zip(values.tolist(), counts.tolist()):
+                self._sparse[v] = self._sparse.get(v, 0) + c
+
+    # Hands every block to the consumers, called as consumer(xoff, yoff, block)
+    def f_consume(self, *consumers):
+        for xoff, yoff, block in self.f_iterBlocks():
+            if not self.counted:
+                self.f_addBlockCounts(block)
+            for consumer in consumers:
+                consumer(xoff, yoff, block)
+        self.counted = True
+
+    # Counts of every value in the raster as a dict
+    def f_returnValueCounts(self):
+        if not self.counted:
+            self.f_consume()
+        if self._dense is not None:
+            values = numpy.flatnonzero(self._dense)
+            return dict(zip(values.tolist(), self._dense[values].tolist()))
+        return dict(self._sparse)
+
+    # Sorted classes of the raster without the nodata value
+    def f_returnClasses(self):
+        return sorted(v for v in self.f_returnValueCounts() if v != self.nodata)
+
+    # Assembles the whole band, counting the values on the way
+    def f_readArray(self):
+        out = []
+
+        def fill(xoff, yoff, block):
+            if not out:  # allocate with the dtype of the first block
+                out.append(numpy.empty(self.shape, dtype=block.dtype))
+            out[0][yoff:yoff + block.shape[0], xoff:xoff + block.shape[1]] = block
+
+        self.f_consume(fill)
+        return out[0]
+
+    # Decodes the band once into an uncompressed .npy file next to the raster and returns it
+    # memory-mapped read-only. The file name is keyed by path, size and mtime of the raster,
+    # caches of older versions of the raster are removed
+    def f_readCachedArray(self):
+        path = os.path.abspath(str(self.raster_path))
+        stat = os.stat(path)
+        key = hashlib.md5("{}|{}|{}".format(path, stat.st_size, stat.st_mtime).encode("utf-8")).hexdigest()[:16]
+        cache_path = "{}.lccache-{}.npy".format(path, key)
+        if os.path.exists(cache_path):
+            return numpy.load(cache_path, mmap_mode="r")
+        for stale in glob.glob("{}.lccache-*.npy".format(glob.escape(path))):
+            os.remove(stale)
+        tmp_path = cache_path + ".tmp"
+        out = []
+
+        def fill(xoff, yoff, block):
+            if not out:  # allocate with the dtype of the first block
+                out.append(numpy.lib.format.open_memmap(tmp_path, mode="w+", dtype=block.dtype, shape=self.shape))
+            out[0][yoff:yoff + block.shape[0], xoff:xoff + block.shape[1]] = block
+
+        self.f_consume(fill)
+        out[0].flush()
+        del out[:]
+        os.replace(tmp_path, cache_path)
+        return numpy.load(cache_path, mmap_mode="r")
+
+    # Landscape metrics from the value counts only
+    def f_returnHistogramAnalysis(self):
+        counts = self.f_returnValueCounts()
+        values = numpy.array(list(counts.keys()))
+        return HistogramAnalysis(list(counts.values()), self.nodata, values=values, cellsize=self.cellsize)
+
+    # Lazy dask array of the band, one chunk per block aligned window of about chunk cells a side.
+    # Every chunk opens the raster itself, so it works on the threaded and the process scheduler
+    def f_readDaskArray(self, chunk=2048):
+        if da is None:
+            logger.warn("error: dask is not installed")
+            return None
+        dtype = self.band.ReadAsArray(0, 0, 1, 1).dtype
+        rows = []
+        for xoff, yoff, xsize, ysize in f_returnWindows(self.band, chunk):
+            if xoff == 0:
+                rows.append([])
+            part = dask.delayed(f_readWindow)(self.raster_path, xoff, yoff, xsize, ysize)
+            rows[-1].append(da.from_delayed(part, (ysize, xsize), dtype=dtype))
+        return da.block(rows)
+
+
+# Reads one pixel window of the first band
+def f_readWindow(raster_path, xoff, yoff, xsize, ysize):
+    return gdal.Open(str(raster_path)).GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+
+
 # Returns the nodata value. Assumes an raster with one band
 def f_returnNoDataValue(rasterPath):
     raster = gdal.Open(str(rasterPath))
@@ -136,13 +331,486 @@ def f_returnNoDataValue(rasterPath):
     return nodata
 
 
+# LC_* metrics that are answered by LandCoverAnalysis.f_returnLandStatistics
+LC_METRICS = ("LC_Mean", "LC_Min", "LC_Sum", "LC_Max", "LC_SD", "LC_LQua", "LC_Med", "LC_UQua")
+LC_QUANTILES = (("LC_LQua", 0.25), ("LC_Med", 0.5), ("LC_UQua", 0.75))
+
+
+# Diversity indices as functions of the class proportions
+def f_shannonIndex(prop):
+    prop = prop[prop > 0]
+    return -numpy.sum(prop * numpy.log(prop))
+
+
+def f_simpsonIndex(prop):
+    return 1 - numpy.sum(numpy.power(prop, 2))
+
+
+def f_evenessIndex(prop):
+    return f_shannonIndex(prop) / math.log(len(prop))
+
+
+DIVERSITY_INDICES = {"shannon": f_shannonIndex,
+                     "simpson": f_simpsonIndex,
+                     "eveness": f_evenessIndex}
+
+
+## Adjacency matrix metrics
+# adjacency is a class by class matrix of ordered 4-neighbour pairs (f_adjacencyCounts with
+# s=1, every shared cell side counted from both cells as in FRAGSTATS double counting)
+
+# Largest number of like adjacencies (single counted) and smallest perimeter of a class
+# with this many cells, reached by packing them into a square
+def f_returnMaximumClumping(cells):
+    n = numpy.floor(numpy.sqrt(cells))
+    m = cells - n * n
+    like = 2 * n * (n - 1) + numpy.where(m == 0, 0, numpy.where(m <= n, 2 * m - 1, 2 * m - 2))
+    edge = 4 * n + numpy.where(m == 0, 0, numpy.where(m <= n, 2, 4))
+    return like, edge
+
+
+# Per class metrics of an adjacency matrix: edges to other classes, proportion of like
+# adjacencies, aggregation index, clumpiness, interspersion and juxtaposition and the
+# join counts (observed and expected under random permutation of the cells)
+def f_returnAdjacencyTable(adjacency, classes, cells, cellsize):
+    g = numpy.asarray(adjacency, dtype=numpy.float64)
+    cells = numpy.asarray(cells, dtype=numpy.float64)
+    like = numpy.diag(g)
+    total = g.sum(axis=1)
+    other = total - like
+    max_like, min_edge = f_returnMaximumClumping(cells)
+    prop = cells / cells.sum()
+    joins = g.sum() / 2
+    n = cells.sum()
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        pladj = like / total * 100
+        ai = like / 2 / max_like * 100
+        # all cell sides of the class, including those on the border or nodata
+        clump = like / (4 * cells - min_edge)
+        clumpy = numpy.where((clump < prop) & (prop < 0.5), (clump - prop) / prop, (clump - prop) / (1 - prop))
+        shares = g / other[:, None]
+        numpy.fill_diagonal(shares, 0)
+        logs = numpy.where(shares > 0, shares * numpy.log(numpy.where(shares > 0, shares, 1)), 0)
+        iji = -logs.sum(axis=1) / math.log(len(classes) - 1) * 100 if len(classes) > 2 else numpy.nan
+        # no adjacencies to other classes leave IJI undefined
+        iji = numpy.where(other > 0, iji, numpy.nan)
+        pairs = n * (n - 1)
+        expected_bb = joins * cells * (cells - 1) / pairs
+        expected_bw = 2 * joins * cells * (n - cells) / pairs
+    table = pd.DataFrame({"edge_length": other * cellsize,
+                          "like_adjacencies": like,
+                          "pladj": pladj,
+                          "ai": ai,
+                          "clumpy": clumpy,
+                          "iji": iji,
+                          "join_bb": like / 2,
+                          "join_bw": other,
+                          "join_ww": joins - like / 2 - other,
+                          "expected_bb": expected_bb,
+                          "expected_bw": expected_bw},
+                         index=pd.Index(classes, name="class"))
+    return table
+
+
+# Contagion index of the landscape (FRAGSTATS CONTAG) from an adjacency matrix and the
+# class proportions
+def f_contagionIndex(adjacency, prop):
+    g = numpy.asarray(adjacency, dtype=numpy.float64)
+    m = len(prop)
+    if m < 2:
+        return numpy.nan
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        q = numpy.asarray(prop)[:, None] * g / g.sum(axis=1)[:, None]
+    q = q[q > 0]
+    return (1 + numpy.sum(q * numpy.log(q)) / (2 * math.log(m))) * 100
+
+
+# Interspersion and juxtaposition index of the landscape (FRAGSTATS IJI)
+def f_interspersionIndex(adjacency):
+    g = numpy.asarray(adjacency, dtype=numpy.float64)
+    m = g.shape[0]
+    if m < 3:
+        return numpy.nan
+    e = g[numpy.triu_indices(m, 1)]
+    e = e[e > 0] / e.sum()
+    return -numpy.sum(e * numpy.log(e)) / math.log(m * (m - 1) / 2.0) * 100
+
+
+## Kernels
+# Each kernel has a NumPy implementation and, if numba is installed, a compiled one that
+# gives identical results. The dispatchers choose by USE_NUMBA
+
+# Perimeter and internal edge counts per label on the 4-neighbourhood, cells outside the
+# array count as background. Internal edges are seen from both cells
+def f_edgeCountsNumpy(labeled_array, numpatches):
+    n = numpatches + 1
+    perimeter = numpy.zeros(n, dtype=numpy.int64)
+    internal = numpy.zeros(n, dtype=numpy.int64)
+    # zero border keeps the label dtype, leading axes of a stack of tiles are not padded
+    pad = [(0, 0)] * (labeled_array.ndim - 2) + [(1, 1), (1, 1)]
+    padded = numpy.pad(labeled_array, pad, mode="constant")
+    for a, b in ((padded[..., :, :-1], padded[..., :, 1:]), (padded[..., :-1, :], padded[..., 1:, :])):
+        diff = a != b
+        perimeter += numpy.bincount(a[diff], minlength=n)
+        perimeter += numpy.bincount(b[diff], minlength=n)
+        internal += numpy.bincount(a[~diff], minlength=n)
+    internal *= 2
+    perimeter[0] = internal[0] = 0
+    return perimeter, internal
+
+
+# Class-by-class neighbour counts. class_index holds the position of each cell's class
+# (-1 for cells outside the classes); every cell counts each of its valid neighbours
+def f_adjacencyNumpy(class_index, nclasses, s=2):
+    counts = numpy.zeros(nclasses * nclasses, dtype=numpy.int64)
+    shifts = [((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+              ((slice(None, -1), slice(None)), (slice(1, None), slice(None)))]
+    if s == 2:
+        shifts += [((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),
+                   ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)))]
+    for a, b in shifts:
+        u, v = class_index[a], class_index[b]
+        both = (u >= 0) & (v >= 0)
+        counts += numpy.bincount(u[both].astype(numpy.int64) * nclasses + v[both], minlength=nclasses * nclasses)
+    counts = counts.reshape(nclasses, nclasses)
+    return counts + counts.T
+
+
+# Ordered neighbour pairs whose first cell lies inside a window padded by one halo cell.
+# Summed over the windows of a raster it equals f_adjacencyCounts of the whole raster
+def f_adjacencyWindow(class_index, nclasses, s=2):
+    h, w = class_index.shape
+    core = class_index[1:-1, 1:-1]
+    counts = numpy.zeros(nclasses * nclasses, dtype=numpy.int64)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if (dr == 0 and dc == 0) or (s == 1 and dr != 0 and dc != 0):
+                continue
+            v = class_index[1 + dr:h - 1 + dr, 1 + dc:w - 1 + dc]
+            both = (core >= 0) & (v >= 0)
+            counts += numpy.bincount(core[both].astype(numpy.int64) * nclasses + v[both], minlength=nclasses * nclasses)
+    return counts.reshape(nclasses, nclasses)
+
+
+# Connected components of cells with the same value, only cells in valid are labeled.
+# Labels are numbered 1..numpatches in raster order of their first cell, like ndimage.label
+def f_labelSameValueNumpy(array, valid, s=2):
+    h, w = array.shape
+    index_dtype = numpy.int32 if h * w < numpy.iinfo(numpy.int32).max else numpy.int64
+    index = numpy.arange(h * w, dtype=index_dtype).reshape(h, w)
+    shifts = [((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+              ((slice(None, -1), slice(None)), (slice(1, None), slice(None)))]
+    if s == 2:
+        shifts += [((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),
+                   ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)))]
+    rows, cols = [], []
+    for a, b in shifts:
+        same = valid[a] & (array[a] == array[b])
+        rows.append(index[a][same])
+        cols.append(index[b][same])
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+    graph = sparse.coo_matrix((numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)), shape=(h * w, h * w))
+    ncomp, comp = connected_components(graph.tocsr(), directed=False)
+    # cells outside valid are singleton components, number the others 1..numpatches
+    valid = valid.ravel()
+    used = numpy.zeros(ncomp, dtype=bool)
+    used[comp[valid]] = True
+    lookup = numpy.cumsum(used).astype(index_dtype)
+    labeled = numpy.zeros(h * w, dtype=index_dtype)
+    labeled[valid] = lookup[comp[valid]]
+    return labeled.reshape(h, w), int(lookup[-1]) if ncomp else 0
+
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def f_edgeCountsNumba(labeled_array, numpatches):
+        h, w = labeled_array.shape
+        perimeter = numpy.zeros(numpatches + 1, dtype=numpy.int64)
+        internal = numpy.zeros(numpatches + 1, dtype=numpy.int64)
+        for r in range(h):
+            for c in range(w):
+                lab = labeled_array[r, c]
+                if lab == 0:
+                    continue
+                for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    rr, cc = r + dr, c + dc
+                    if 0 <= rr < h and 0 <= cc < w and labeled_array[rr, cc] == lab:
+                        internal[lab] += 1
+                    else:
+                        perimeter[lab] += 1
+        return perimeter, internal
+
+    @numba.njit(cache=True, nogil=True)
+    def f_adjacencyNumba(class_index, nclasses, s=2):
+        h, w = class_index.shape
+        counts = numpy.zeros((nclasses, nclasses), dtype=numpy.int64)
+        for r in range(h):
+            for c in range(w):
+                ci = class_index[r, c]
+                if ci < 0:
+                    continue
+                for dr in range(-1, 2):
+                    for dc in range(-1, 2):
+                        if (dr == 0 and dc == 0) or (s == 1 and dr != 0 and dc != 0):
+                            continue
+                        rr, cc = r + dr, c + dc
+                        if 0 <= rr < h and 0 <= cc < w and class_index[rr, cc] >= 0:
+                            counts[ci, class_index[rr, cc]] += 1
+        return counts
+
+    @numba.njit(cache=True, nogil=True)
+    def f_findRoot(parent, x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    # Two pass union-find labeling, the root of every set is its first cell in raster order.
+    # parent (arange of the cells) and labeled (zeros) are given in the index dtype
+    @numba.njit(cache=True, nogil=True)
+    def f_labelSameValueKernel(array, valid, s, parent, labeled):
+        h, w = array.shape
+        for r in range(h):
+            for c in range(w):
+                if not valid[r, c]:
+                    continue
+                idx = r * w + c
+                for dr, dc in ((0, -1), (-1, 0), (-1, -1), (-1, 1)):
+                    if s == 1 and dr != 0 and dc != 0:
+                        continue
+                    rr, cc = r + dr, c + dc
+                    if 0 <= rr < h and 0 <= cc < w and valid[rr, cc] and array[rr, cc] == array[r, c]:
+                        a = f_findRoot(parent, idx)
+                        b = f_findRoot(parent, rr * w + cc)
+                        if a < b:
+                            parent[b] = a
+                        elif b < a:
+                            parent[a] = b
+        numpatches = 0
+        for r in range(h):
+            for c in range(w):
+                if not valid[r, c]:
+                    continue
+                idx = r * w + c
+                root = f_findRoot(parent, idx)
+                if root == idx:
+                    numpatches += 1
+                    labeled[r, c] = numpatches
+                else:
+                    labeled[r, c] = labeled[root // w, root % w]
+        return labeled, numpatches
+
+    # Labels in int32 when the cell count fits, like f_labelSameValueNumpy
+    def f_labelSameValueNumba(array, valid, s=2):
+        h, w = array.shape
+        index_dtype = numpy.int32 if h * w < numpy.iinfo(numpy.int32).max else numpy.int64
+        return f_labelSameValueKernel(array, valid, s, numpy.arange(h * w, dtype=index_dtype),
+                                      numpy.zeros((h, w), dtype=index_dtype))
+
+
+def f_edgeCounts(labeled_array, numpatches):
+    if USE_NUMBA and numba is not None:
+        if labeled_array.ndim == 3:
+            # a zero row below every tile keeps the tiles apart in one 2d array
+            padded = numpy.pad(labeled_array, [(0, 0), (0, 1), (0, 0)], mode="constant")
+            labeled_array = padded.reshape(-1, labeled_array.shape[2])
+        return f_edgeCountsNumba(labeled_array, numpatches)
+    return f_edgeCountsNumpy(labeled_array, numpatches)
+
+
+def f_adjacencyCounts(class_index, nclasses, s=2):
+    if USE_NUMBA and numba is not None:
+        return f_adjacencyNumba(class_index, nclasses, s)
+    return f_adjacencyNumpy(class_index, nclasses, s)
+
+
+def f_labelSameValue(array, valid, s=2):
+    if USE_NUMBA and numba is not None:
+        return f_labelSameValueNumba(array, valid, s)
+    return f_labelSameValueNumpy(array, valid, s)
+
+
+# Unique keys and the smallest value of each
+def f_returnMinimumByKey(keys, values):
+    if len(keys) == 0:
+        return keys, values
+    order = numpy.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    first = numpy.concatenate(([0], numpy.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    return keys[first], numpy.minimum.reduceat(values, first)
+
+
+# Position of every cell's value in classes (in the given order), -1 where the value is
+# not a class
+def f_returnClassIndex(array, classes):
+    classes = numpy.asarray(classes)
+    if len(classes) == 0:
+        return numpy.full(array.shape, -1, dtype=numpy.int32)
+    order = numpy.argsort(classes, kind="stable")
+    ranked = classes[order]
+    pos = numpy.searchsorted(ranked, array)
+    pos[pos == len(classes)] = 0
+    return numpy.where(ranked[pos] == array, order[pos], -1).astype(numpy.int32)
+
+
+# Smallest unsigned label dtype that can hold every patch of a mask with this shape
+def f_returnLabelDtype(shape, s=2):
+    h, w = shape
+    if s == 2:
+        bound = ((h + 1) // 2) * ((w + 1) // 2)  # 8-connected patches are at least one cell apart
+    else:
+        bound = (h * w + 1) // 2
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if bound <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.int64
+
+
+# Foreground cells of one class as sorted linear indices into a raster of the given shape.
+# Labeling, edge counts and edge cells only look at the foreground cells and their
+# neighbours, so they cost O(cells) instead of O(raster)
+class SparseForeground():
+    def __init__(self, index, shape):
+        self.index = numpy.asarray(index, dtype=numpy.int64)
+        self.shape = shape
+        self.rows, self.cols = numpy.divmod(self.index, shape[1])
+
+    # Position of the neighbour (dr, dc) of every cell in self.index, -1 if it is not foreground
+    def f_returnNeighbour(self, dr, dc):
+        h, w = self.shape
+        rr, cc = self.rows + dr, self.cols + dc
+        inside = (rr >= 0) & (rr < h) & (cc >= 0) & (cc < w)
+        target = rr * w + cc
+        pos = numpy.searchsorted(self.index, target)
+        pos[pos == len(self.index)] = 0
+        found = inside & (self.index[pos] == target) if len(self.index) else inside
+        return numpy.where(found, pos, -1)
+
+    # Labels 1..numpatches in raster order of the first cell of each patch, like ndimage.label
+    def f_label(self, s=2):
+        n = len(self.index)
+        if n == 0:
+            return numpy.zeros(0, dtype=numpy.int32), 0
+        offsets = [(0, 1), (1, 0)] if s == 1 else [(0, 1), (1, -1), (1, 0), (1, 1)]
+        src, dst = [], []
+        for dr, dc in offsets:
+            pos = self.f_returnNeighbour(dr, dc)
+            hit = pos >= 0
+            src.append(numpy.flatnonzero(hit))
+            dst.append(pos[hit])
+        src, dst = numpy.concatenate(src), numpy.concatenate(dst)
+        graph = sparse.coo_matrix((numpy.ones(len(src), dtype=numpy.int8), (src, dst)), shape=(n, n))
+        numpatches, component = connected_components(graph, directed=False)
+        first = numpy.full(numpatches, n)
+        numpy.minimum.at(first, component, numpy.arange(n))
+        rank = numpy.empty(numpatches, dtype=numpy.int32)
+        rank[numpy.argsort(first)] = numpy.arange(1, numpatches + 1)
+        return rank[component], numpatches
+
+    # Patch perimeters and internal edges on the 4-neighbourhood, as f_edgeCounts
+    def f_edgeCounts(self, labels, numpatches):
+        inside = numpy.zeros(len(self.index), dtype=numpy.int64)
+        for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            inside += self.f_returnNeighbour(dr, dc) >= 0
+        internal = numpy.bincount(labels, weights=inside, minlength=numpatches + 1).astype(numpy.int64)
+        cells = numpy.bincount(labels, minlength=numpatches + 1)
+        return 4 * cells - internal, internal
+
+    # Coordinates and labels of the cells with a 4-neighbour outside the class
+    def f_returnEdgeCells(self, labels):
+        edge = numpy.zeros(len(self.index), dtype=bool)
+        for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            edge |= self.f_returnNeighbour(dr, dc) < 0
+        return numpy.column_stack((self.rows[edge], self.cols[edge])), labels[edge]
+
+    # Dense label raster. The zero fill is not touched apart from the foreground cells
+    def f_toDense(self, labels, dtype=numpy.int32):
+        dense = numpy.zeros(self.shape, dtype=dtype)
+        dense.ravel()[self.index] = labels
+        return dense
+
+
 class LandCoverAnalysis():
-    def __init__(self, array, cellsize, classes, nodata=None):
+    # compact=True keeps class masks as bool and labels in the smallest fitting dtype
+    def __init__(self, array, cellsize, classes, nodata=None, compact=False):
+        self.compact = compact
         self.array = array
         self.cellsize = cellsize
         self.cellsize_2 = math.pow(cellsize, 2)
         self.classes = classes
         self.nodata = nodata
+        self.labeled_array = None
+        self.patch_table = None
+        self.labeled_all = None
+        self.patch_ids = None
+        self.foreground = None
+        self.edge_distances = {}
+        self.patch_graphs = {}
+        self.connectivity = {}
+        self.geotransform = None
+        self.projection = ""
+
+    # Landscape level quantities (value histogram, cell counts, valid mask) and the labels
+    # of f_cclAll are cached and dropped whenever array or classes are reassigned.
+    # In-place edits of either need an explicit f_clearLandscapeCache()
+    @property
+    def array(self):
+        return self._array
+
+    @array.setter
+    def array(self, array):
+        self._array = array
+        self.f_clearLandscapeCache()
+
+    @property
+    def classes(self):
+        return self._classes
+
+    @classes.setter
+    def classes(self, classes):
+        self._classes = classes
+        self.f_clearLandscapeCache()
+
+    def f_clearLandscapeCache(self):
+        self._landscape_cache = {}
+        self.labeled_all = None
+        self.label_class = None
+        self.patch_table_all = None
+
+    # Counts of every value in the array, computed once
+    def f_returnValueCounts(self):
+        if "value_counts" not in self._landscape_cache:
+            values, counts = f_countValues(self.array)
+            self._landscape_cache["value_counts"] = dict(zip(values.tolist(), counts.tolist()))
+        return self._landscape_cache["value_counts"]
+
+    # Seeds the value counts when they are already known, e.g. from a RasterBlockReader
+    def f_setValueCounts(self, value_counts):
+        self._landscape_cache["value_counts"] = dict(value_counts)
+
+    # Number of cells per class
+    def f_returnClassHistogram(self):
+        if "class_histogram" not in self._landscape_cache:
+            counts = self.f_returnValueCounts()
+            self._landscape_cache["class_histogram"] = dict((cl, counts.get(cl, 0)) for cl in self.classes)
+        return self._landscape_cache["class_histogram"]
+
+    # Number of cells covered by the classes. Class 0 is not counted as landscape
+    def f_returnLandscapeCellNumber(self):
+        if "landscape_cells" not in self._landscape_cache:
+            hist = self.f_returnClassHistogram()
+            self._landscape_cache["landscape_cells"] = sum(n for cl, n in hist.items() if cl != 0)
+        return self._landscape_cache["landscape_cells"]
+
+    # Boolean mask of all cells that are not nodata
+    def f_returnValidMask(self):
+        if "valid_mask" not in self._landscape_cache:
+            if self.nodata is None:
+                self._landscape_cache["valid_mask"] = numpy.ones(self.array.shape, dtype=bool)
+            else:
+                self._landscape_cache["valid_mask"] = self.array != self.nodata
+        return self._landscape_cache["valid_mask"]
 
     # Alternative count_nonzero function from scipy if available
     def count_nonzero(self, array):
@@ -153,61 +821,21 @@ class LandCoverAnalysis():
         else:
             return (array != 0).sum()
 
-    # Executes the Metric functions
+    # Executes the Metric functions registered in SINGLE_METRICS
     def execSingleMetric(self, name, cl) -> Tuple[str, float]:
         self.cl = cl
-        if (name == unicode("Land cover")):
-            return unicode(name), self.f_returnArea(self.labeled_array)
-        if (name == unicode("Landscape Proportion")):
-            return unicode(name), self.f_returnProportion(self.array, cl)
-        elif (name == unicode("Edge length")):
-            return unicode(name), self.f_returnEdgeLength(self.labeled_array)
-        elif (name == unicode("Edge density")):
-            return unicode(name), self.f_returnEdgeDensity(self.labeled_array)
-        elif (name == unicode("Number of Patches")):
-            return unicode(name), self.numpatches
-        elif (name == unicode("Patch density")):
-            return unicode(name), self.f_patchDensity(self.numpatches)
-        elif (name == unicode("Greatest patch area")):
-            return unicode(name), self.f_returnPatchArea(self.cl_array, self.labeled_array, self.numpatches, "max")
-        elif (name == unicode("Smallest patch area")):
-            return unicode(name), self.f_returnPatchArea(self.cl_array, self.labeled_array, self.numpatches, "min")
-        elif (name == unicode("Mean patch area")):
-            return unicode(name), self.f_returnPatchArea(self.cl_array, self.labeled_array, self.numpatches, "mean")
-        elif (name == unicode("Median patch area")):
-            return unicode(name), self.f_returnPatchArea(self.cl_array, self.labeled_array, self.numpatches, "median")
-        elif (name == unicode("Largest Patch Index")):
-            return unicode(name), self.f_returnLargestPatchIndex(self.cl_array, self.labeled_array, self.numpatches)
-        elif (name == unicode("Mean patch perimeter")):
-            return unicode(name), self.f_returnAvgPatchPerimeter(self.labeled_array)
-        elif (name == unicode("Fractal Dimension Index")):
-            return unicode(name), self.f_getFractalDimensionIndex(self.cl_array, self.labeled_array, self.numpatches)
-        elif (name == unicode("Mean patch shape ratio")):
-            return unicode(name), self.f_returnAvgShape(self.labeled_array, self.cl_array, self.numpatches)
-        elif (name == unicode("Mean Shape Index")):
-            return unicode(name), self.f_returnAvgShape(self.labeled_array, self.cl_array, self.numpatches,
-                                                        correction=True)
-        elif (name == unicode("Overall Core area")):
-            return unicode(name), self.f_getCoreArea(self.labeled_array)
-        elif (name == unicode("Like adjacencies")):
-            return unicode(name), self.f_getPropLikeAdj(self.labeled_array, self.numpatches)
-        elif (name == unicode("Euclidean Nearest-Neighbor Distance")):
-            return unicode(name), self.f_returnAvgPatchDist(self.labeled_array, self.numpatches, metric="euclidean")
-        elif (name == unicode("Patch cohesion index")):
-            return unicode(name), self.f_getCohesionIndex(self.cl_array, self.labeled_array, self.numpatches)
-        elif (name == unicode("Landscape division")):
-            return unicode(name), self.f_returnLandscapeDivisionIndex(self.array, self.labeled_array, self.numpatches,
-                                                                      cl)
-        elif (name == unicode("Splitting Index")):
-            return unicode(name), self.f_returnSplittingIndex(self.array, self.numpatches, self.labeled_array, cl)
-        elif (name == unicode("Effective Meshsize")):
-            return unicode(name), self.f_returnEffectiveMeshSize(self.array, self.labeled_array, self.numpatches, cl)
+        if name in SINGLE_METRICS:
+            needs, func = SINGLE_METRICS[name]
+            return unicode(name), func(self, cl)
         else:
             return "None", 0.0
 
     # don't know where the original cl_array comes from, so we make it
     def create_cl_array_for_class(self, cl):
-        if cl == 0:  # If class 0 exists
+        self.cl = cl
+        if self.compact:
+            self.cl_array = self.array == cl
+        elif cl == 0:  # If class 0 exists
             arr = numpy.zeros_like(self.array)
             arr[self.array == cl] = 1
             self.cl_array = arr
@@ -221,7 +849,151 @@ class LandCoverAnalysis():
         # Binary structure
         self.cl_array = cl_array
         struct = scipy.ndimage.generate_binary_structure(s, s)
-        self.labeled_array, self.numpatches = ndimage.label(cl_array, struct)
+        if self.compact:
+            labeled_array = numpy.empty(cl_array.shape, dtype=f_returnLabelDtype(cl_array.shape, s))
+            numpatches = ndimage.label(cl_array, struct, output=labeled_array)
+            dtype = numpy.min_scalar_type(numpatches)
+            if dtype.itemsize < labeled_array.dtype.itemsize:
+                labeled_array = labeled_array.astype(dtype)
+            self.labeled_array, self.numpatches = labeled_array, numpatches
+        else:
+            self.labeled_array, self.numpatches = ndimage.label(cl_array, struct)
+        self.patch_table = None
+        self.patch_ids = None
+        self.foreground = None
+        self.edge_distances = {}
+        self.patch_graphs = {}
+        self.connectivity = {}
+
+    # Share of the raster covered by the class
+    def f_returnClassDensity(self, cl):
+        return self.f_returnClassHistogram().get(cl, 0) / float(self.array.size)
+
+    # Labels the class from its cell list (SparseForeground). Sets the same attributes as
+    # create_cl_array_for_class and f_ccl, the patch table is built from the cell list
+    def f_cclSparse(self, cl, s=2):
+        self.cl = cl
+        self.patch_ids = None
+        foreground = SparseForeground(numpy.flatnonzero(self.array == cl), self.array.shape)
+        labels, numpatches = foreground.f_label(s)
+        dtype = numpy.min_scalar_type(max(numpatches, 1)) if self.compact else numpy.int32
+        self.labeled_array = foreground.f_toDense(labels, dtype)
+        self.cl_array = self.labeled_array  # non-zero exactly on the class cells
+        self.numpatches = numpatches
+        perimeter, internal = foreground.f_edgeCounts(labels, numpatches)
+        cells = numpy.bincount(labels, minlength=numpatches + 1)
+        self.patch_table = pd.DataFrame({"cells": cells[1:],
+                                         "area": cells[1:] * self.cellsize_2,
+                                         "perimeter": perimeter[1:],
+                                         "internal_edges": internal[1:]},
+                                        index=pd.RangeIndex(1, numpatches + 1, name="label"))
+        self.foreground = foreground
+        self.foreground_labels = labels
+        self.edge_distances = {}
+        self.patch_graphs = {}
+        self.connectivity = {}
+
+    # Returns a per-class analysis for cl. It is a shallow copy that shares the array and the
+    # landscape cache with this analysis but has its own cl, cl_array, labeled_array,
+    # numpatches and patch_table, so several classes can be evaluated concurrently
+    def f_classContext(self, cl, s=2):
+        context = copy.copy(self)
+        context.cl = cl
+        if self.labeled_all is not None:
+            context.f_selectClass(cl)
+        elif self.f_returnClassDensity(cl) < SPARSE_DENSITY:
+            context.f_cclSparse(cl, s)
+        else:
+            context.create_cl_array_for_class(cl)
+            context.f_ccl(context.cl_array, s)
+        return context
+
+    # Connected component labeling of all classes at once. Neighbours are only connected if
+    # they have the same value, so patches never span two classes. Sets labeled_all, the
+    # label to class lookup label_class and the grouped patch table patch_table_all
+    def f_cclAll(self, s=2):
+        array = self.array
+        valid = numpy.isin(array, self.classes)
+        self.labeled_all, self.numpatches_all = f_labelSameValue(array, valid, s)
+        if self.compact:
+            dtype = numpy.min_scalar_type(self.numpatches_all)
+            if dtype.itemsize < self.labeled_all.dtype.itemsize:
+                self.labeled_all = self.labeled_all.astype(dtype)
+        self.label_class = numpy.zeros(self.numpatches_all + 1, dtype=array.dtype)
+        self.label_class[self.labeled_all] = array
+        self.patch_table_all = self.f_buildPatchTable(self.labeled_all, self.numpatches_all)
+        self.patch_table_all.insert(0, "class", self.label_class[1:])
+
+    # Makes cl the current class after f_cclAll, without masking or labeling again.
+    # The class patches are renumbered 1..numpatches and the class rows of the grouped
+    # patch table become the current patch table
+    def f_selectClass(self, cl):
+        self.cl = cl
+        self.foreground = None
+        self.edge_distances = {}
+        self.patch_graphs = {}
+        self.connectivity = {}
+        ids = numpy.flatnonzero(self.label_class == cl)
+        ids = ids[ids > 0]
+        lookup = numpy.zeros(self.numpatches_all + 1, dtype=self.labeled_all.dtype)
+        lookup[ids] = numpy.arange(1, len(ids) + 1)
+        self.labeled_array = lookup[self.labeled_all]
+        self.cl_array = self.labeled_array  # non-zero exactly on the class cells
+        self.numpatches = len(ids)
+        self.patch_ids = ids  # labels in labeled_all
+        table = self.patch_table_all.loc[ids].drop(columns="class")
+        table.index = pd.RangeIndex(1, len(ids) + 1, name="label")
+        self.patch_table = table
+
+    # Writes the raster, the all-classes labeling, the grouped patch table, the value counts
+    # and the cellsize to path. Without compressed, path is a directory of .npy files that
+    # LC_LoadState memory-maps, with compressed a single .npz file.
+    # Labels all classes first if f_cclAll has not been run
+    def f_saveState(self, path, compressed=False):
+        if self.labeled_all is None:
+            self.f_cclAll()
+        counts = self.f_returnValueCounts()
+        meta = {"cellsize": self.cellsize, "nodata": self.nodata, "compact": self.compact,
+                "numpatches_all": int(self.numpatches_all), "geotransform": self.geotransform,
+                "projection": self.projection}
+        state = {"array": numpy.asarray(self.array),
+                 "classes": numpy.asarray(self.classes),
+                 "values": numpy.array(list(counts.keys())),
+                 "counts": numpy.array(list(counts.values()), dtype=numpy.int64),
+                 "labeled_all": self.labeled_all,
+                 "label_class": self.label_class,
+                 # numpy scalars (e.g. a uint8 nodata) and arrays become python values
+                 "meta": numpy.array(json.dumps(meta, default=lambda value: numpy.asarray(value).tolist()))}
+        for column in self.patch_table_all.columns:
+            state["patch_" + column] = self.patch_table_all[column].to_numpy()
+        if compressed:
+            numpy.savez_compressed(path, **state)
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, value in state.items():
+            numpy.save(os.path.join(path, name + ".npy"), value)
+
+    # Per-patch attribute table, built in one pass over the labeled array
+    # Rows are indexed by label (1..numpatches), edges are counted on the 4-neighbourhood
+    def f_returnPatchTable(self, labeled_array, numpatches):
+        if labeled_array is self.labeled_array and self.patch_table is not None:
+            return self.patch_table
+        table = self.f_buildPatchTable(labeled_array, numpatches)
+        if labeled_array is self.labeled_array:
+            self.patch_table = table
+        return table
+
+    def f_buildPatchTable(self, labeled_array, numpatches):
+        n = numpatches + 1
+        cells = numpy.bincount(labeled_array.ravel(), minlength=n)
+        perimeter, internal = f_edgeCounts(labeled_array, numpatches)
+        table = pd.DataFrame({"cells": cells[1:],
+                              "area": cells[1:] * self.cellsize_2,
+                              "perimeter": perimeter[1:],
+                              "internal_edges": internal[1:]},
+                             index=pd.RangeIndex(1, n, name="label"))
+        return table
 
         ## Landscape Metrics
 
@@ -263,73 +1035,173 @@ class LandCoverAnalysis():
                 return unicode(name), "NaN"
             else:
                 return unicode(name), self.f_returnDiversity("simpson", nodata)
+        if name == "CONTAG":
+            return unicode(name), f_contagionIndex(self.f_returnAdjacency(1), self.f_returnClassProportions())
+        if name == "IJI":
+            return unicode(name), f_interspersionIndex(self.f_returnAdjacency(1))
+
+    # Executes several Landscape Metrics at once
+    # LC_* metrics share one compacted copy of the valid pixels, one reduction for the
+    # moments and one partition for min, max and the quartiles
+    def execLandMetrics(self, names, nodata):
+        lc_names = [name for name in names if name in LC_METRICS]
+        lc_values = self.f_returnLandStatistics(lc_names, nodata) if lc_names else {}
+        res = []
+        for name in names:
+            if name in lc_values:
+                res.append((unicode(name), lc_values[name]))
+            else:
+                res.append(self.execLandMetric(name, nodata))
+        return res
 
-    # Calculates a Diversity Index    
+    # Returns a dict with the requested LC_* metrics of the valid pixels
+    def f_returnLandStatistics(self, names, nodata):
+        if nodata == self.nodata:
+            values = self.array[self.f_returnValidMask()]
+        else:
+            values = self.array[self.array != nodata]
+        n = values.size
+        res = {}
+        if n == 0:
+            for name in names:
+                res[name] = numpy.nan
+            return res
+        if "LC_Mean" in names or "LC_Sum" in names or "LC_SD" in names:
+            fvalues = values.astype(numpy.float64)
+            total = numpy.sum(fvalues)
+            mean = total / n
+            res["LC_Sum"] = total
+            res["LC_Mean"] = mean
+            d = fvalues - mean
+            res["LC_SD"] = math.sqrt(numpy.dot(d, d) / n)
+        # positions of the order statistics, quantiles use linear interpolation like numpy.percentile
+        quantiles = [(name, q * (n - 1)) for name, q in LC_QUANTILES if name in names]
+        kth = set()
+        for name, pos in quantiles:
+            kth.update((int(math.floor(pos)), int(math.ceil(pos))))
+        if "LC_Min" in names:
+            kth.add(0)
+        if "LC_Max" in names:
+            kth.add(n - 1)
+        if kth:
+            values.partition(sorted(kth))
+            res["LC_Min"] = values[0]
+            res["LC_Max"] = values[n - 1]
+            for name, pos in quantiles:
+                lo = values[int(math.floor(pos))]
+                hi = values[int(math.ceil(pos))]
+                res[name] = lo + (float(hi) - float(lo)) * (pos - math.floor(pos))
+        return dict((name, res[name]) for name in names)
+
+    # Calculates a Diversity Index from the class histogram
     def f_returnDiversity(self, index, nodata):
-        if (index == "shannon"):
-            sh = []
-            cl_array = numpy.copy(self.array)  # create working array
-            cl_array[cl_array == int(nodata)] = 0
-            for cl in self.classes:
-                res = []
-                for i in self.classes:
-                    if i == 0:  # If class 0 exists
-                        arr = numpy.zeros_like(self.array)
-                        arr[self.array == i] = 1
-                    else:
-                        arr = numpy.copy(self.array)
-                        arr[self.array != i] = 0
-                    res.append(self.count_nonzero(arr))
-                if cl == 0:  # If class 0 exists
-                    arr = numpy.zeros_like(self.array)
-                    arr[self.array == cl] = 1
-                else:
-                    arr = numpy.copy(self.array)
-                    arr[self.array != cl] = 0
-                prop = self.count_nonzero(arr) / float(sum(res))
-                sh.append(prop * math.log(prop))
-            return sum(sh) * -1
-        elif (index == "simpson"):
-            si = []
-            cl_array = numpy.copy(self.array)  # create working array
-            cl_array[cl_array == int(nodata)] = 0
-            for cl in self.classes:
-                res = []
-                for i in self.classes:
-                    if i == 0:  # If class 0 exists
-                        arr = numpy.zeros_like(self.array)
-                        arr[self.array == i] = 1
-                    else:
-                        arr = numpy.copy(self.array)
-                        arr[self.array != i] = 0
-                    res.append(self.count_nonzero(arr))
-                if cl == 0:  # If class 0 exists
-                    arr = numpy.zeros_like(self.array)
-                    arr[self.array == cl] = 1
-                else:
-                    arr = numpy.copy(self.array)
-                    arr[self.array != cl] = 0
-                prop = self.count_nonzero(arr) / float(sum(res))
-                si.append(math.pow(prop, 2))
-            return 1 - sum(si)
-        elif (index == "eveness"):
-            return self.f_returnDiversity("shannon", nodata) / math.log(len(self.classes))
+        return DIVERSITY_INDICES[index](self.f_returnClassProportions())
+
+    # Calculates all Diversity Indices at once, sharing one class histogram
+    def f_returnDiversityIndices(self, nodata, indices=None):
+        if indices is None:
+            indices = DIVERSITY_INDICES.keys()
+        prop = self.f_returnClassProportions()
+        return dict((index, DIVERSITY_INDICES[index](prop)) for index in indices)
+
+    # Proportion of each class among all class cells
+    def f_returnClassProportions(self):
+        if "class_proportions" not in self._landscape_cache:
+            counts = numpy.array(list(self.f_returnClassHistogram().values()), dtype=numpy.float64)
+            self._landscape_cache["class_proportions"] = counts / counts.sum()
+        return self._landscape_cache["class_proportions"]
+
+    # Class adjacency matrix of the landscape (ordered neighbour pairs over self.classes)
+    def f_returnAdjacency(self, s=1):
+        key = "adjacency_{}".format(s)
+        if key not in self._landscape_cache:
+            class_index = f_returnClassIndex(self.array, self.classes)
+            self._landscape_cache[key] = f_adjacencyCounts(class_index, len(self.classes), s)
+        return self._landscape_cache[key]
+
+    # Adjacency metrics of every class from one 4-neighbour adjacency matrix
+    def f_returnAdjacencyMetrics(self):
+        if "adjacency_metrics" not in self._landscape_cache:
+            hist = self.f_returnClassHistogram()
+            self._landscape_cache["adjacency_metrics"] = f_returnAdjacencyTable(
+                self.f_returnAdjacency(1), self.classes, [hist[cl] for cl in self.classes], self.cellsize)
+        return self._landscape_cache["adjacency_metrics"]
+
+    def f_returnAdjacencyMetric(self, cl, column):
+        table = self.f_returnAdjacencyMetrics()
+        if cl not in table.index:
+            return numpy.nan
+        return table.at[cl, column]
+
+    # Edge length between every pair of classes
+    def f_returnClassPairEdgeLength(self):
+        g = self.f_returnAdjacency(1) * float(self.cellsize)
+        numpy.fill_diagonal(g, 0)
+        return pd.DataFrame(g, index=pd.Index(self.classes, name="class"), columns=self.classes)
+
+    # One row per patch of the current class: label (and patch_id in labeled_all after
+    # f_cclAll), area, perimeter, core area at depth, shape index, bounding box and
+    # centroid in cells, and the centroid in map coordinates if the geotransform is known
+    def f_returnPatchRecords(self, depth=None, tile_id=None):
+        n = self.numpatches
+        depth = self.cellsize if depth is None else depth
+        table = self.f_returnPatchTable(self.labeled_array, n)
+        moments = self.f_returnPatchMoments(self.labeled_array, n)
+        core = self.f_returnCoreAreas(self.labeled_array, n, [depth])[1] if n > 0 else None
+        records = pd.DataFrame({"class": numpy.full(n, self.cl),
+                                "label": numpy.arange(1, n + 1, dtype=numpy.int64)})
+        if tile_id is not None:
+            records.insert(0, "tile_id", str(tile_id))
+        if self.patch_ids is not None:
+            records["patch_id"] = numpy.asarray(self.patch_ids, dtype=numpy.int64)
+        records["cells"] = table["cells"].values.astype(numpy.int64)
+        records["area"] = table["area"].values.astype(numpy.float64)
+        records["perimeter"] = table["perimeter"].values * float(self.cellsize)
+        records["core_area"] = core["core_area"].values.astype(numpy.float64) if n > 0 else numpy.zeros(0)
+        records["shape_index"] = 0.25 * table["perimeter"].values / numpy.sqrt(table["cells"].values)
+        for column in ("min_row", "max_row", "min_col", "max_col", "row", "col"):
+            records[column] = moments[column].values
+        if self.geotransform is not None:
+            gt = self.geotransform
+            records["x"] = gt[0] + (moments["col"].values + 0.5) * gt[1] + (moments["row"].values + 0.5) * gt[2]
+            records["y"] = gt[3] + (moments["col"].values + 0.5) * gt[4] + (moments["row"].values + 0.5) * gt[5]
+        return records
+
+    # Writes the patch records of the classes as Parquet, one row group per class. writer is
+    # a file name or an open PatchWriter (e.g. shared by the tiles of a run). With label_path
+    # the labels of all classes (patch_id) are written as a tiled GeoTIFF with overviews
+    def f_exportPatches(self, writer, classes=None, tile_id=None, label_path=None, depth=None):
+        if pq is None:
+            logger.warn("error: pyarrow is not installed")
+            return None
+        if self.labeled_all is None:
+            self.f_cclAll()
+        own = not isinstance(writer, PatchWriter)
+        if own:
+            writer = PatchWriter(writer)
+        for cl in (self.classes if classes is None else classes):
+            writer.f_write(self.f_classContext(cl).f_returnPatchRecords(depth, tile_id))
+        if own:
+            writer.f_close()
+        if label_path is not None:
+            f_writeLabelRaster(label_path, self.labeled_all, self.geotransform or (0, self.cellsize, 0, 0, 0, -self.cellsize),
+                               self.projection)
+        return writer
 
     ## Class Metrics
     # Return the total area for the given class
     def f_returnArea(self, labeled_array):
         # sizes = scipy.ndimage.sum(array, labeled_array, range(numpatches + 1)).astype(labeled_array.dtype)
+        if labeled_array is self.labeled_array and self.foreground is not None:
+            return len(self.foreground.index) * self.cellsize_2
         area = self.count_nonzero(labeled_array) * self.cellsize_2
         return area
 
     # Aggregates all class area, equals the sum of total area for each class
     def f_LandscapeArea(self):
-        res = []
-        for i in self.classes:
-            arr = numpy.copy(self.array)
-            arr[self.array != i] = 0
-            res.append(self.f_returnArea(arr))
-        self.Larea = sum(res)
+        if "Larea" not in self._landscape_cache:
+            self._landscape_cache["Larea"] = self.f_returnLandscapeCellNumber() * self.cellsize_2
+        self.Larea = self._landscape_cache["Larea"]
 
     # Return Patchdensity
     def f_patchDensity(self, numpatches):
@@ -342,6 +1214,8 @@ class LandCoverAnalysis():
 
     # Return array with a specific labeled patch
     def f_returnPatch(self, labeled_array, patch):
+        if self.compact:
+            return labeled_array == patch
         # Make an array of zeros the same shape as `a`.
         feature = numpy.zeros_like(labeled_array, dtype=int)
         feature[labeled_array == patch] = 1
@@ -361,6 +1235,8 @@ class LandCoverAnalysis():
 
     # Returns sum of patches perimeter
     def f_returnPatchPerimeter(self, labeled_array):
+        if labeled_array is self.labeled_array:
+            return int(self.f_returnPatchTable(labeled_array, self.numpatches)["perimeter"].sum())
         labeled_array = self.f_setBorderZero(labeled_array)  # make a border with zeroes
         TotalPerimeter = numpy.sum(labeled_array[:, 1:] != labeled_array[:, :-1]) + numpy.sum(
             labeled_array[1:, :] != labeled_array[:-1, :])
@@ -371,7 +1247,7 @@ class LandCoverAnalysis():
         # Internal edge: Count of neighboring non-zero cell       
         kernel = ndimage.generate_binary_structure(2, 1)  # Make a kernel
         kernel[1, 1] = 0
-        b = ndimage.convolve(cl_array, kernel, mode="constant")
+        b = ndimage.convolve((cl_array != 0).astype(numpy.uint8), kernel, mode="constant")
         n_interior = b[cl_array != 0].sum()  # Number of interiror edges
         return n_interior
 
@@ -387,26 +1263,108 @@ class LandCoverAnalysis():
     # Returns the given matrix with a zero border coloumn and row around
     def f_setBorderZero(self, matrix):
         heightFP, widthFP = matrix.shape  # define hight and width of input matrix
-        withBorders = numpy.ones((heightFP + (2 * 1), widthFP + (2 * 1))) * 0  # set the border to borderValue
+        withBorders = numpy.zeros((heightFP + (2 * 1), widthFP + (2 * 1)), dtype=matrix.dtype)  # set the border to borderValue
         withBorders[1:heightFP + 1, 1:widthFP + 1] = matrix  # set the interior region to the input matrix
         return withBorders
 
     # Returns the overall Core-Area
-    def f_getCoreArea(self, labeled_array):
-        s = ndimage.generate_binary_structure(2, 2)
-        newlab = ndimage.binary_erosion(labeled_array, s).astype(labeled_array.dtype)
-        return ndimage.sum(newlab) * self.cellsize_2
+    # Cells further than depth (map units, default one cell) from the patch edge are core
+    def f_getCoreArea(self, labeled_array, depth=None, metric="chessboard"):
+        if depth is None:
+            depth = self.cellsize
+        dist = self.f_returnDistanceToEdge(labeled_array, metric)
+        return self.count_nonzero(dist > depth) * self.cellsize_2
+
+    # Distance of every patch cell to the nearest cell outside the class, in map units.
+    # Cells outside the raster count as outside. metric is "chessboard" or "euclidean".
+    # The transform of the current labeled array is kept, so core area and edge influence
+    # metrics of one class share it
+    def f_returnDistanceToEdge(self, labeled_array, metric="chessboard"):
+        if labeled_array is self.labeled_array and metric in self.edge_distances:
+            return self.edge_distances[metric]
+        padded = numpy.pad(labeled_array != 0, 1, mode="constant")
+        if metric == "euclidean":
+            dist = ndimage.distance_transform_edt(padded, sampling=self.cellsize)
+        else:
+            dist = ndimage.distance_transform_cdt(padded, metric="chessboard") * float(self.cellsize)
+        dist = dist[1:-1, 1:-1]
+        if labeled_array is self.labeled_array:
+            self.edge_distances[metric] = dist
+        return dist
+
+    # Histogram of the Euclidean distance to edge of the class cells. bins are the upper
+    # bounds in map units (lower < distance <= upper), the last row counts everything further in
+    def f_returnEdgeDistanceHistogram(self, labeled_array, bins):
+        dist = self.f_returnDistanceToEdge(labeled_array, "euclidean")
+        inside = dist[labeled_array != 0]
+        upper = numpy.concatenate((numpy.sort(bins), [numpy.inf]))
+        cells = numpy.bincount(numpy.searchsorted(upper, inside), minlength=len(upper))
+        return pd.DataFrame({"lower": numpy.concatenate(([0], upper[:-1])), "upper": upper, "cells": cells,
+                             "area": cells * self.cellsize_2})
+
+    # Share of the class cells at most depth map units from an edge (edge cells are one
+    # cellsize away)
+    def f_returnEdgeInfluence(self, labeled_array, depth=None):
+        depth = EDGE_DEPTH if depth is None else depth
+        dist = self.f_returnDistanceToEdge(labeled_array, "euclidean")
+        cells = self.count_nonzero(labeled_array)
+        if cells == 0:
+            return numpy.nan
+        return self.count_nonzero((dist > 0) & (dist <= depth)) / float(cells)
+
+    # Mean Euclidean distance of the class cells to the nearest edge
+    def f_returnMeanEdgeDistance(self, labeled_array):
+        dist = self.f_returnDistanceToEdge(labeled_array, "euclidean")
+        inside = labeled_array != 0
+        if not inside.any():
+            return numpy.nan
+        return numpy.mean(dist[inside])
+
+    # Mean proximity index (FRAGSTATS PROX): per patch the sum of area / distance^2 of the
+    # other patches whose edges are within radius, from the patch graph
+    def f_returnProximityIndex(self, labeled_array, numpatches, radius=None):
+        radius = PROXIMITY_RADIUS if radius is None else radius
+        if numpatches == 0:
+            return numpy.nan
+        area = self.f_returnPatchTable(labeled_array, numpatches)["area"].values.astype(float)
+        graph = self.f_returnPatchGraph(labeled_array, numpatches, radius).tocoo()
+        prox = numpy.bincount(graph.row, weights=area[graph.col] / numpy.power(graph.data, 2), minlength=numpatches)
+        return numpy.mean(prox)
+
+    # Core areas for several edge depths (map units) from a single distance transform.
+    # Returns a summary per depth (total core area, number of core areas, core area index)
+    # and a per patch table indexed by (depth, label)
+    def f_returnCoreAreas(self, labeled_array, numpatches, depths, metric="chessboard"):
+        dist = self.f_returnDistanceToEdge(labeled_array, metric)
+        n = numpatches + 1
+        areas = numpy.bincount(labeled_array.ravel(), minlength=n)[1:] * self.cellsize_2
+        struct = ndimage.generate_binary_structure(2, 2)
+        patches = []
+        for depth in depths:
+            core = dist > depth
+            core_area = numpy.bincount(labeled_array[core], minlength=n)[1:] * self.cellsize_2
+            # every core area lies inside one patch
+            core_labels, ncores = ndimage.label(core, struct)
+            patch_of_core = numpy.zeros(ncores + 1, dtype=numpy.int64)
+            patch_of_core[core_labels[core]] = labeled_array[core]
+            n_cores = numpy.bincount(patch_of_core[1:], minlength=n)[1:]
+            patches.append(pd.DataFrame({"depth": depth,
+                                         "label": numpy.arange(1, n),
+                                         "core_area": core_area,
+                                         "n_core_areas": n_cores,
+                                         "core_area_index": core_area / areas * 100}))
+        patches = pd.concat(patches).set_index(["depth", "label"])
+        summary = patches.groupby(level="depth").agg({"core_area": "sum", "n_core_areas": "sum"})
+        summary["core_area_index"] = summary["core_area"] / areas.sum() * 100
+        return summary, patches
 
     # Calculate the cohesion index    
     # Hint: Likely wrong behaviour of internal edges
     def f_getCohesionIndex(self, cl_array, labeled_array, numpatches):
         # First calculate internal edges and number of cells of each patch
-        internalEdges = numpy.array([]).astype(float)
-        areas = numpy.array([]).astype(float)
-        for i in range(1, numpatches + 1):  # Very slow!
-            feature = self.f_returnPatch(labeled_array, i)
-            areas = numpy.append(areas, float(self.count_nonzero(feature)))
-            internalEdges = numpy.append(internalEdges, float(self.f_returnInternalEdge(feature)))
+        table = self.f_returnPatchTable(labeled_array, numpatches)
+        internalEdges = table["internal_edges"].values.astype(float)
+        areas = table["cells"].values.astype(float)
         Larea = cl_array.size  # The total number of cells in the landscape
         val = ((1 - (numpy.sum(internalEdges) / numpy.sum(numpy.multiply(internalEdges, numpy.sqrt(areas))))) * (
                     (1 - 1 / numpy.sqrt(Larea)) / 10)) * 100
@@ -414,67 +1372,56 @@ class LandCoverAnalysis():
 
     # Calculate adjacenies
     def f_getPropLikeAdj(self, labeled_array, numpatches):
-        internalEdges = numpy.array([]).astype(float)
-        outerEdges = numpy.array([]).astype(float)
-        for i in range(1, numpatches + 1):  # Very slow!
-            feature = self.f_returnPatch(labeled_array, i)
-            outerEdges = numpy.append(outerEdges, float(self.f_returnPatchPerimeter(feature)))
-            internalEdges = numpy.append(internalEdges, float(self.f_returnInternalEdge(feature)))
-
+        table = self.f_returnPatchTable(labeled_array, numpatches)
+        internalEdges = table["internal_edges"].values.astype(float)
+        outerEdges = table["perimeter"].values.astype(float)
         prop = numpy.sum(internalEdges) / numpy.sum(internalEdges + outerEdges * 2)
         return prop
 
     # Calculates the Fractal dimension index patchwise
     def f_getFractalDimensionIndex(self, cl_array, labeled_array, numpatches):
         # Calculate patchwise
-        frac = numpy.array([]).astype(float)
-        #        sizes = ndimage.sum(cl_array,labeled_array,range(1,numpatches+1)) # all area sizes
-        #        sizes = sizes[sizes!=0] # remove zeros
-        #        def func(x):
-        #            return x.sum()
-
-        #       b = ndimage.distance_transform_edt(cl_array == 0) == 1
-        #       lbl2, n = ndimage.label(b,ndimage.generate_binary_structure(2,2))
-        #       o = ndimage.labeled_comprehension(input = b,labels = lbl2,index = range(1, n+1),func = func,out_dtype='float', default=-1)
-
-        #        fdi = (2.0 * numpy.log(sizes * 0.25) ) / numpy.log( o )
-        #        numpy.mean(fdi)
-        for i in range(1, numpatches + 1):  # Very slow!
-            feature = self.f_returnPatch(labeled_array, i)
-            a = float(self.f_returnArea(feature))
-            p = float(self.f_returnEdgeLength(feature))
-            fdi = (2.0 * numpy.log(0.25 * p)) / numpy.log(a)
-            frac = numpy.append(frac, fdi)
+        table = self.f_returnPatchTable(labeled_array, numpatches)
+        a = table["area"].values.astype(float)
+        p = table["perimeter"].values * float(self.cellsize)
+        frac = (2.0 * numpy.log(0.25 * p)) / numpy.log(a)
         return numpy.mean(frac)
 
     # Return greatest, smallest or mean patch area
     def f_returnPatchArea(self, cl_array, labeled_array, numpatches, what):
-        sizes = ndimage.sum(cl_array, labeled_array, range(1, numpatches + 1))
-        sizes = sizes[sizes != 0]  # remove zeros
+        sizes = self.f_returnPatchTable(labeled_array, numpatches)["area"].values
         if len(sizes) != 0:
             if what == "max":
-                return (numpy.max(sizes) * self.cellsize_2) / int(self.cl)
+                return numpy.max(sizes)
             elif what == "min":
-                return (numpy.min(sizes) * self.cellsize_2) / int(self.cl)
+                return numpy.min(sizes)
             elif what == "mean":
-                return (numpy.mean(sizes) * self.cellsize_2) / int(self.cl)
+                return numpy.mean(sizes)
             elif what == "median":
-                return (numpy.median(sizes) * self.cellsize_2) / int(self.cl)
+                return numpy.median(sizes)
         else:
             return None
 
     # Returns the proportion of the labeled class in the landscape
     def f_returnProportion(self, array, cl):
-        arr = numpy.copy(array)
-        arr[array != cl] = 0
+        # Class 0 is not counted as landscape, as in f_LandscapeArea
+        if cl == 0:
+            n_class = 0
+        elif array is self.array:
+            n_class = self.f_returnValueCounts().get(cl, 0)
+        else:
+            n_class = self.count_nonzero(array == cl)
+        n_total = self.f_returnTotalCellNumber(array)
         try:
-            prop = self.count_nonzero(arr) / float(self.count_nonzero(array))
+            prop = n_class / float(n_total)
         except ZeroDivisionError:
             prop = None
         return prop
 
     # Returns the total number of cells in the array
     def f_returnTotalCellNumber(self, array):
+        if array is self.array:
+            return int(sum(n for v, n in self.f_returnValueCounts().items() if v != 0))
         return int(self.count_nonzero(array))
 
     # Returns a tuple with the position of the largest patch
@@ -482,38 +1429,189 @@ class LandCoverAnalysis():
     def f_returnPosLargestPatch(self, labeled_array):
         return numpy.unravel_index(labeled_array.argmax(), labeled_array.shape)
 
-    # Get average distance between landscape patches
+    # Per-patch location and extent from one pass over the patch cells: cell count, centroid
+    # (row, col), bounding box and radius of gyration (root mean square distance of the cells
+    # from the centroid, in map units). Rows are indexed by label (1..numpatches)
+    def f_returnPatchMoments(self, labeled_array, numpatches):
+        if labeled_array is self.labeled_array and self.foreground is not None:
+            rows, cols, labels = self.foreground.rows, self.foreground.cols, self.foreground_labels
+        else:
+            rows, cols = numpy.nonzero(labeled_array)
+            labels = labeled_array[rows, cols]
+        n = numpatches + 1
+        cells = numpy.bincount(labels, minlength=n)
+        frows, fcols = rows.astype(numpy.float64), cols.astype(numpy.float64)
+        sum_r = numpy.bincount(labels, weights=frows, minlength=n)
+        sum_c = numpy.bincount(labels, weights=fcols, minlength=n)
+        sum_rr = numpy.bincount(labels, weights=frows * frows, minlength=n)
+        sum_cc = numpy.bincount(labels, weights=fcols * fcols, minlength=n)
+        bounds = []
+        for coords, ufunc, start in ((rows, numpy.minimum, labeled_array.shape[0]), (rows, numpy.maximum, -1),
+                                     (cols, numpy.minimum, labeled_array.shape[1]), (cols, numpy.maximum, -1)):
+            bound = numpy.full(n, start, dtype=numpy.int64)
+            ufunc.at(bound, labels, coords)
+            bounds.append(bound)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            row, col = sum_r / cells, sum_c / cells
+            variance = sum_rr / cells - row * row + sum_cc / cells - col * col
+        table = pd.DataFrame({"cells": cells[1:],
+                              "row": row[1:],
+                              "col": col[1:],
+                              "min_row": bounds[0][1:],
+                              "max_row": bounds[1][1:],
+                              "min_col": bounds[2][1:],
+                              "max_col": bounds[3][1:],
+                              "gyration": numpy.sqrt(numpy.maximum(variance[1:], 0)) * self.cellsize},
+                             index=pd.RangeIndex(1, n, name="label"))
+        return table
+
+    # Correlation length: area weighted mean radius of gyration of the patches
+    def f_returnCorrelationLength(self, labeled_array, numpatches):
+        if numpatches == 0:
+            return numpy.nan
+        moments = self.f_returnPatchMoments(labeled_array, numpatches)
+        cells = moments["cells"].values.astype(float)
+        return numpy.sum(cells * moments["gyration"].values) / numpy.sum(cells)
+
+    # Get mean Euclidean nearest-neighbour distance between landscape patches
     def f_returnAvgPatchDist(self, labeled_array, numpatches, metric="euclidean"):
         if numpatches == 0:
             return numpy.nan
         elif numpatches < 2:
             return 0
         else:
-            """
-            Takes a labeled array as returned by scipy.ndimage.label and 
-            returns an intra-feature distance matrix.
-            Solution by @morningsun at StackOverflow
-            """
-            I, J = numpy.nonzero(labeled_array)
-            labels = labeled_array[I, J]
-            coords = numpy.column_stack((I, J))
-
-            sorter = numpy.argsort(labels)
-            labels = labels[sorter]
-            coords = coords[sorter]
-
-            sq_dists = cdist(coords, coords, 'sqeuclidean')
-
-            start_idx = numpy.flatnonzero(numpy.r_[1, numpy.diff(labels)])
-            nonzero_vs_feat = numpy.minimum.reduceat(sq_dists, start_idx, axis=1)
-            feat_vs_feat = numpy.minimum.reduceat(nonzero_vs_feat, start_idx, axis=0)
-
-            # Get lower triangle and zero distances to nan
-            b = numpy.tril(numpy.sqrt(feat_vs_feat))
-            b[b == 0] = numpy.nan
-            res = numpy.nanmean(b) * self.cellsize  # Calculate mean and multiply with cellsize
-
-            return res
+            return numpy.mean(self.f_returnPatchDist(labeled_array, numpatches))
+
+    # Returns the edge cells of all patches as (coordinates, labels)
+    # An edge cell has at least one 4-neighbour outside its patch, the nearest cell
+    # of a patch to anything outside of it is always such a cell
+    def f_returnEdgeCells(self, labeled_array):
+        if labeled_array is self.labeled_array and self.foreground is not None:
+            return self.foreground.f_returnEdgeCells(self.foreground_labels)
+        padded = numpy.pad(labeled_array, 1, mode="constant")
+        inner = padded[1:-1, 1:-1]
+        edge = (inner != padded[:-2, 1:-1]) | (inner != padded[2:, 1:-1]) | \
+               (inner != padded[1:-1, :-2]) | (inner != padded[1:-1, 2:])
+        edge &= inner != 0
+        I, J = numpy.nonzero(edge)
+        return numpy.column_stack((I, J)), labeled_array[I, J]
+
+    # Returns the Euclidean distance from every patch to its nearest neighbouring patch
+    # (index 0 is label 1). Uses a KD-tree over the edge cells, so memory grows with
+    # the number of edge cells
+    def f_returnPatchDist(self, labeled_array, numpatches, k=8, max_k=256, chunk=16384):
+        coords, labels = self.f_returnEdgeCells(labeled_array)
+        ncells = len(labels)
+        enn = numpy.full(numpatches + 1, numpy.inf)
+        if numpatches < 2:
+            return enn[1:]
+        tree = cKDTree(coords)
+        pending = numpy.arange(ncells)
+        while len(pending) > 0 and k <= max_k:
+            kk = min(k, ncells)
+            unresolved = []
+            for start in range(0, len(pending), chunk):
+                cells = pending[start:start + chunk]
+                dist, idx = tree.query(coords[cells], k=kk)
+                other = labels[idx] != labels[cells][:, None]
+                found = other.any(axis=1)
+                first = other.argmax(axis=1)
+                numpy.minimum.at(enn, labels[cells[found]], dist[found, first[found]])
+                # the nearest foreign cell is further away than the k-th neighbour
+                bound = dist[~found, -1]
+                keep = cells[~found]
+                unresolved.append(keep[bound < enn[labels[keep]]])
+            pending = numpy.concatenate(unresolved)
+            k *= 4
+        # Isolated patches with long edges: search against all other patches directly
+        for lab in numpy.unique(labels[pending]):
+            own = labels == lab
+            dist, idx = cKDTree(coords[~own]).query(coords[own])
+            enn[lab] = min(enn[lab], dist.min())
+        return enn[1:] * self.cellsize
+
+    # Sparse symmetric patch graph (numpatches x numpatches, index 0 is label 1) linking
+    # patches whose edge cells are at most threshold map units apart. The weight is the
+    # smallest edge to edge distance. Edge cells are searched chunk by chunk on a KD-tree,
+    # a chunk has at most about pairs cell pairs whatever the threshold. The graphs of the
+    # current labeled array are kept per threshold, so connectivity and proximity share them
+    def f_returnPatchGraph(self, labeled_array, numpatches, threshold, pairs=1 << 22):
+        if labeled_array is self.labeled_array and threshold in self.patch_graphs:
+            return self.patch_graphs[threshold]
+        coords, labels = self.f_returnEdgeCells(labeled_array)
+        radius = threshold / float(self.cellsize)
+        chunk = max(64, int(pairs / (math.pi * radius * radius + 1)))
+        tree = cKDTree(coords)
+        keys, dists = [], []
+        for start in range(0, len(labels), chunk):
+            part = cKDTree(coords[start:start + chunk])
+            found = part.sparse_distance_matrix(tree, radius, output_type="ndarray")
+            a, b = labels[found["i"] + start].astype(numpy.int64), labels[found["j"]].astype(numpy.int64)
+            keep = a < b
+            # only the smallest distance per patch pair of the chunk is kept
+            part_keys, part_dists = f_returnMinimumByKey(a[keep] * (numpatches + 1) + b[keep], found["v"][keep])
+            keys.append(part_keys)
+            dists.append(part_dists)
+        keys = numpy.concatenate(keys) if keys else numpy.zeros(0, dtype=numpy.int64)
+        dists = numpy.concatenate(dists) if dists else numpy.zeros(0)
+        keys, dists = f_returnMinimumByKey(keys, dists)
+        dists = dists * self.cellsize
+        a, b = numpy.divmod(keys, numpatches + 1)
+        graph = sparse.coo_matrix((dists, (a - 1, b - 1)), shape=(numpatches, numpatches)).tocsr()
+        graph = graph + graph.T
+        if labeled_array is self.labeled_array:
+            self.patch_graphs[threshold] = graph
+        return graph
+
+    # Integral Index of Connectivity and Probability of Connectivity of the class
+    # (Pascual-Hortal & Saura 2006, Saura & Pascual-Hortal 2007). Links are the patch pairs
+    # within threshold, a link of length d has probability exp(-theta d) with
+    # exp(-theta threshold) = probability, and PC uses the most probable path.
+    # Shortest paths run on groups of whole connected components of up to batch patches
+    # (pairs in different components contribute nothing) and in chunks of source patches.
+    # PC paths are only followed while their probability stays above epsilon, IIC needs all
+    # pairs of a component. Both indices of the current labeled array are kept per
+    # (threshold, probability), so IIC and PC share one run
+    def f_returnConnectivity(self, labeled_array, numpatches, threshold=None, probability=None, chunk=256,
+                             batch=256, epsilon=1e-6):
+        threshold = CONNECTIVITY_DISTANCE if threshold is None else threshold
+        probability = CONNECTIVITY_PROBABILITY if probability is None else probability
+        key = (threshold, probability)
+        if labeled_array is self.labeled_array and key in self.connectivity:
+            return self.connectivity[key]
+        self.f_LandscapeArea()
+        if numpatches == 0 or self.Larea == 0:
+            return {"IIC": numpy.nan, "PC": numpy.nan}
+        area = self.f_returnPatchTable(labeled_array, numpatches)["area"].values.astype(float)
+        graph = self.f_returnPatchGraph(labeled_array, numpatches, threshold)
+        theta = -math.log(probability) / threshold
+        ncomponents, component = connected_components(graph, directed=False)
+        sizes = numpy.bincount(component, minlength=ncomponents)
+        # isolated patches only connect to themselves
+        single = sizes[component] == 1
+        iic = pc = numpy.sum(area[single] ** 2)
+        order = numpy.argsort(component, kind="stable")
+        order = order[~single[order]]
+        ends = numpy.cumsum(sizes[sizes > 1])
+        start = 0
+        while start < len(order):
+            # as many whole components as fit in batch, at least the next one
+            last = numpy.searchsorted(ends, start + batch, side="right") - 1
+            stop = max(ends[last] if last >= 0 else 0, ends[numpy.searchsorted(ends, start, side="right")])
+            nodes = order[start:stop]
+            start = stop
+            sub = graph[nodes][:, nodes]
+            a = area[nodes]
+            for first in range(0, len(nodes), chunk):
+                sources = numpy.arange(first, min(first + chunk, len(nodes)))
+                links = shortest_path(sub, directed=False, unweighted=True, indices=sources)
+                iic += numpy.sum(a[sources][:, None] * a[None, :] / (1 + links))
+                dist = dijkstra(sub, directed=False, indices=sources, limit=-math.log(epsilon) / theta)
+                pc += numpy.sum(a[sources][:, None] * a[None, :] * numpy.exp(-theta * dist))
+        result = {"IIC": iic / self.Larea ** 2, "PC": pc / self.Larea ** 2}
+        if labeled_array is self.labeled_array:
+            self.connectivity[key] = result
+        return result
 
     # Get average Patch Perimeter of given landscape patch
     # FIXME: can't be right
@@ -526,13 +1624,9 @@ class LandCoverAnalysis():
         # Average shape (ratio perimeter/area) of each patches of each lc-class
 
     def f_returnAvgShape(self, labeled_array, cl_array, numpatches, correction=False):
-        perim = numpy.array([]).astype(float)
-        for i in range(1, numpatches + 1):  # Very slow!
-            feature = self.f_returnPatch(labeled_array, i)
-            p = numpy.sum(feature[:, 1:] != feature[:, :-1]) + numpy.sum(feature[1:, :] != feature[:-1, :])
-            perim = numpy.append(perim, p)
-        area = ndimage.sum(cl_array, labeled_array, range(numpatches + 1)).astype(float)
-        area = area[area != 0]
+        table = self.f_returnPatchTable(labeled_array, numpatches)
+        perim = table["perimeter"].values.astype(float)
+        area = table["cells"].values.astype(float)
         if correction:
             a = 0.25 * perim
             b = numpy.sqrt(area)
@@ -543,33 +1637,15 @@ class LandCoverAnalysis():
 
     # Returns the Landscape division Index for the given array
     def f_returnLandscapeDivisionIndex(self, array, labeled_array, numpatches, cl):
-        res = []
-        for i in self.classes:
-            arr = numpy.copy(array)
-            arr[array != i] = 0
-            res.append(self.count_nonzero(arr))
-        Lcell = float(sum(res))
-        res = []
-        sizes = ndimage.sum(array, labeled_array, range(1, numpatches + 1))
-        sizes = sizes[sizes != 0]  # remove zeros
-        for i in sizes:
-            area = (i) / int(cl)
-            val = math.pow(float(area) / Lcell, 2)
-            res.append(val)
-        return (1 - sum(res))
-
-        # Returns the Splitting index for the given array
+        Lcell = float(self.f_returnLandscapeCellNumber())
+        sizes = self.f_returnPatchTable(labeled_array, numpatches)["cells"].values
+        return 1 - numpy.sum(numpy.power(sizes / Lcell, 2))
 
+    # Returns the Splitting index for the given array
     def f_returnSplittingIndex(self, array, numpatches, labeled_array, cl):
         self.f_LandscapeArea()  # Calculate LArea
-        res = []
-        sizes = ndimage.sum(array, labeled_array, range(1, numpatches + 1))
-        sizes = sizes[sizes != 0]  # remove zeros
-        for i in sizes:
-            area = (i * self.cellsize_2) / int(cl)
-            val = math.pow(area, 2)
-            res.append(val)
-        area = sum(res)
+        sizes = self.f_returnPatchTable(labeled_array, numpatches)["area"].values.astype(float)
+        area = numpy.sum(numpy.power(sizes, 2))
         larea2 = math.pow(self.Larea, 2)
         if area != 0:
             si = float(larea2) / float(area)
@@ -580,13 +1656,8 @@ class LandCoverAnalysis():
     # Returns the Effective Mesh Size Index for the given array
     def f_returnEffectiveMeshSize(self, array, labeled_array, numpatches, cl):
         self.f_LandscapeArea()  # Calculate LArea
-        res = []
-        sizes = ndimage.sum(array, labeled_array, range(1, numpatches + 1))
-        sizes = sizes[sizes != 0]  # remove zeros
-        for i in sizes:
-            area = (i * self.cellsize_2) / int(cl)
-            res.append(math.pow(area, 2))
-        Earea = sum(res)
+        sizes = self.f_returnPatchTable(labeled_array, numpatches)["area"].values.astype(float)
+        Earea = numpy.sum(numpy.power(sizes, 2))
         try:
             eM = float(Earea) / float(self.Larea)
         except ZeroDivisionError:
@@ -594,20 +1665,258 @@ class LandCoverAnalysis():
         return eM
 
 
-def LC_Initialize(raster_path, nodata=None):
-    # raster = "extract_utm.tif"
+# Class metrics: name -> (intermediates the metric needs, function(analysis, cl)).
+# Intermediates are "labels" (labeled_array and numpatches of the class), "patch_table",
+# "landscape_area" (Larea), "landscape_counts" (class histogram) and "adjacency" (the
+# class adjacency metrics). compute_metrics evaluates each needed intermediate once before
+# the metrics read it from the analysis
+SINGLE_METRICS = {
+    "Land cover": (
+        ("labels",), lambda lc, cl: lc.f_returnArea(lc.labeled_array)),
+    "Landscape Proportion": (
+        ("landscape_counts",), lambda lc, cl: lc.f_returnProportion(lc.array, cl)),
+    "Edge length": (
+        ("labels", "patch_table"), lambda lc, cl: lc.f_returnEdgeLength(lc.labeled_array)),
+    "Edge density": (
+        ("labels", "patch_table", "landscape_area"), lambda lc, cl: lc.f_returnEdgeDensity(lc.labeled_array)),
+    "Number of Patches": (
+        ("labels",), lambda lc, cl: lc.numpatches),
+    "Patch density": (
+        ("labels", "landscape_area"), lambda lc, cl: lc.f_patchDensity(lc.numpatches)),
+    "Greatest patch area": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnPatchArea(lc.cl_array, lc.labeled_array, lc.numpatches, "max")),
+    "Smallest patch area": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnPatchArea(lc.cl_array, lc.labeled_array, lc.numpatches, "min")),
+    "Mean patch area": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnPatchArea(lc.cl_array, lc.labeled_array, lc.numpatches, "mean")),
+    "Median patch area": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnPatchArea(lc.cl_array, lc.labeled_array, lc.numpatches, "median")),
+    "Largest Patch Index": (
+        ("labels", "patch_table", "landscape_area"),
+        lambda lc, cl: lc.f_returnLargestPatchIndex(lc.cl_array, lc.labeled_array, lc.numpatches)),
+    "Mean patch perimeter": (
+        ("labels",), lambda lc, cl: lc.f_returnAvgPatchPerimeter(lc.labeled_array)),
+    "Fractal Dimension Index": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_getFractalDimensionIndex(lc.cl_array, lc.labeled_array, lc.numpatches)),
+    "Mean patch shape ratio": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnAvgShape(lc.labeled_array, lc.cl_array, lc.numpatches)),
+    "Mean Shape Index": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_returnAvgShape(lc.labeled_array, lc.cl_array, lc.numpatches, correction=True)),
+    "Overall Core area": (
+        ("labels",), lambda lc, cl: lc.f_getCoreArea(lc.labeled_array)),
+    "Like adjacencies": (
+        ("labels", "patch_table"), lambda lc, cl: lc.f_getPropLikeAdj(lc.labeled_array, lc.numpatches)),
+    "Euclidean Nearest-Neighbor Distance": (
+        ("labels",), lambda lc, cl: lc.f_returnAvgPatchDist(lc.labeled_array, lc.numpatches, metric="euclidean")),
+    "Patch cohesion index": (
+        ("labels", "patch_table"),
+        lambda lc, cl: lc.f_getCohesionIndex(lc.cl_array, lc.labeled_array, lc.numpatches)),
+    "Landscape division": (
+        ("labels", "patch_table", "landscape_counts"),
+        lambda lc, cl: lc.f_returnLandscapeDivisionIndex(lc.array, lc.labeled_array, lc.numpatches, cl)),
+    "Splitting Index": (
+        ("labels", "patch_table", "landscape_area"),
+        lambda lc, cl: lc.f_returnSplittingIndex(lc.array, lc.numpatches, lc.labeled_array, cl)),
+    "Effective Meshsize": (
+        ("labels", "patch_table", "landscape_area"),
+        lambda lc, cl: lc.f_returnEffectiveMeshSize(lc.array, lc.labeled_array, lc.numpatches, cl)),
+    "Correlation length": (
+        ("labels",), lambda lc, cl: lc.f_returnCorrelationLength(lc.labeled_array, lc.numpatches)),
+    "Integral index of connectivity": (
+        ("labels", "patch_table", "landscape_area"),
+        lambda lc, cl: lc.f_returnConnectivity(lc.labeled_array, lc.numpatches)["IIC"]),
+    "Probability of connectivity": (
+        ("labels", "patch_table", "landscape_area"),
+        lambda lc, cl: lc.f_returnConnectivity(lc.labeled_array, lc.numpatches)["PC"]),
+    "Edge influence": (
+        ("labels",), lambda lc, cl: lc.f_returnEdgeInfluence(lc.labeled_array)),
+    "Mean distance to edge": (
+        ("labels",), lambda lc, cl: lc.f_returnMeanEdgeDistance(lc.labeled_array)),
+    "Proximity index": (
+        ("labels", "patch_table"), lambda lc, cl: lc.f_returnProximityIndex(lc.labeled_array, lc.numpatches)),
+    "Class edge length": (
+        ("adjacency",), lambda lc, cl: lc.f_returnAdjacencyMetric(cl, "edge_length")),
+    "Proportion of like adjacencies": (
+        ("adjacency",), lambda lc, cl: lc.f_returnAdjacencyMetric(cl, "pladj")),
+    "Aggregation index": (
+        ("adjacency",), lambda lc, cl: lc.f_returnAdjacencyMetric(cl, "ai")),
+    "Clumpiness index": (
+        ("adjacency",), lambda lc, cl: lc.f_returnAdjacencyMetric(cl, "clumpy")),
+    "Interspersion and juxtaposition": (
+        ("adjacency",), lambda lc, cl: lc.f_returnAdjacencyMetric(cl, "iji")),
+}
+
+
+# Landscape metrics from a value histogram (counts[v] is the number of cells with value v)
+# Gives the same LC_* and diversity values as LandCoverAnalysis for integer rasters
+class HistogramAnalysis():
+    def __init__(self, counts, nodata=None, values=None, cellsize=1):
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        values = numpy.arange(counts.size) if values is None else numpy.asarray(values)
+        order = numpy.argsort(values)
+        keep = counts[order] > 0
+        self.values = values[order][keep]
+        self.counts = counts[order][keep]
+        self.nodata = nodata
+        self.cellsize = cellsize
+        self.cellsize_2 = math.pow(cellsize, 2)
+        self.classes = [v for v in self.values.tolist() if v != nodata]
+
+    # Values and counts without the nodata value
+    def f_returnValidCounts(self, nodata):
+        if nodata is None:
+            return self.values, self.counts
+        keep = self.values != nodata
+        return self.values[keep], self.counts[keep]
+
+    # Number of cells per class
+    def f_returnClassHistogram(self):
+        values, counts = self.f_returnValidCounts(self.nodata)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    # Class metrics that only need the cell counts
+    def execSingleMetric(self, name, cl):
+        if name == unicode("Land cover"):
+            return unicode(name), self.f_returnClassHistogram().get(cl, 0) * self.cellsize_2
+        elif name == unicode("Landscape Proportion"):
+            return unicode(name), self.f_returnProportion(cl)
+        else:
+            return None, None
 
-    raster = gdal.Open(str(raster_path))
-    gt = raster.GetGeoTransform()
-    logger.warn(gt)
-    pixelSizeX = gt[1]
-    pixelSizeY = -gt[5]
+    # Proportion of the class among all non-zero cells, as LandCoverAnalysis.f_returnProportion
+    def f_returnProportion(self, cl):
+        total = self.counts[self.values != 0].sum()
+        if total == 0:
+            return None
+        return (0 if cl == 0 else self.f_returnClassHistogram().get(cl, 0)) / float(total)
 
-    logger.debug(pixelSizeX)
-    logger.debug(pixelSizeY)
+    def execLandMetrics(self, names, nodata):
+        lc_names = [name for name in names if name in LC_METRICS]
+        lc_values = self.f_returnLandStatistics(lc_names, nodata) if lc_names else {}
+        res = []
+        for name in names:
+            if name in lc_values:
+                res.append((unicode(name), lc_values[name]))
+            else:
+                res.append(self.execLandMetric(name, nodata))
+        return res
 
-    band = raster.GetRasterBand(1)
+    def execLandMetric(self, name, nodata):
+        if name in LC_METRICS:
+            return unicode(name), self.f_returnLandStatistics([name], nodata)[name]
+        if name in ("DIV_SH", "DIV_EV", "DIV_SI"):
+            if len(self.classes) == 1:
+                logger.warn(
+                    "LecoS: Warning, This tool needs at least two landcover classes to calculate landscape diversity!")
+                return unicode(name), "NaN"
+            index = {"DIV_SH": "shannon", "DIV_EV": "eveness", "DIV_SI": "simpson"}[name]
+            return unicode(name), self.f_returnDiversity(index, nodata)
+
+    def f_returnDiversity(self, index, nodata):
+        counts = self.f_returnValidCounts(self.nodata)[1].astype(numpy.float64)
+        return DIVERSITY_INDICES[index](counts / counts.sum())
+
+    def f_returnLandStatistics(self, names, nodata):
+        values, counts = self.f_returnValidCounts(nodata)
+        n = int(counts.sum())
+        res = {}
+        if n == 0:
+            for name in names:
+                res[name] = numpy.nan
+            return res
+        fvalues = values.astype(numpy.float64)
+        total = numpy.dot(fvalues, counts)
+        mean = total / n
+        res["LC_Sum"] = total
+        res["LC_Mean"] = mean
+        res["LC_SD"] = math.sqrt(numpy.dot(numpy.power(fvalues - mean, 2), counts) / n)
+        res["LC_Min"] = values[0]
+        res["LC_Max"] = values[-1]
+        # k-th order statistic is the first value whose cumulative count exceeds k
+        cum = numpy.cumsum(counts)
+        for name, q in LC_QUANTILES:
+            pos = q * (n - 1)
+            lo = fvalues[numpy.searchsorted(cum, int(math.floor(pos)), side="right")]
+            hi = fvalues[numpy.searchsorted(cum, int(math.ceil(pos)), side="right")]
+            res[name] = lo + (hi - lo) * (pos - math.floor(pos))
+        return dict((name, res[name]) for name in names)
+
+
+# Landscape metrics of a lazy dask array. Value counts, class edges and adjacencies are
+# reduced chunk by chunk on the given dask scheduler ("threads", "processes" or
+# "synchronous"), so memory scales with the chunk size rather than the raster size.
+# Patch based metrics need the whole raster, use LC_LabelTiled for those
+class DaskLandCoverAnalysis(HistogramAnalysis):
+    def __init__(self, array, cellsize, nodata=None, scheduler="threads"):
+        self.array = array
+        self.scheduler = scheduler
+        self._adjacency = {}
+        values, counts = self.f_returnChunkValueCounts()
+        HistogramAnalysis.__init__(self, counts, nodata, values=values, cellsize=cellsize)
+
+    def f_compute(self, parts):
+        return dask.compute(*parts, scheduler=self.scheduler)
+
+    # Value counts of every chunk, merged
+    def f_returnChunkValueCounts(self):
+        parts = self.f_compute([dask.delayed(f_countValues)(block) for block in self.array.to_delayed().ravel()])
+        merged = {}
+        for values, counts in parts:
+            for v, n in zip(values.tolist(), counts.tolist()):
+                merged[v] = merged.get(v, 0) + n
+        return numpy.array(list(merged.keys())), numpy.array(list(merged.values()), dtype=numpy.int64)
+
+    # Class adjacency matrix (ordered neighbour pairs) over self.classes, as f_adjacencyCounts
+    def f_returnAdjacency(self, s=2):
+        if s not in self._adjacency:
+            classes = self.classes
+            index = self.array.map_blocks(f_returnClassIndex, classes, dtype=numpy.int32)
+            padded = da.overlap.overlap(index, depth=1, boundary=-1)
+            parts = self.f_compute([dask.delayed(f_adjacencyWindow)(block, len(classes), s)
+                                    for block in padded.to_delayed().ravel()])
+            self._adjacency[s] = numpy.sum(parts, axis=0) if parts else numpy.zeros((0, 0), dtype=numpy.int64)
+        return self._adjacency[s]
+
+    # Number of cell sides per class that face another value, nodata or the raster border.
+    # Equals the summed patch perimeters of the class in LandCoverAnalysis
+    def f_returnClassEdges(self):
+        hist = self.f_returnClassHistogram()
+        like = numpy.diag(self.f_returnAdjacency(1))
+        return dict((cl, 4 * hist[cl] - int(like[i])) for i, cl in enumerate(self.classes))
+
+    def f_returnAdjacencyMetrics(self):
+        hist = self.f_returnClassHistogram()
+        return f_returnAdjacencyTable(self.f_returnAdjacency(1), self.classes, [hist[cl] for cl in self.classes],
+                                      self.cellsize)
 
+    def execLandMetric(self, name, nodata):
+        if name == "CONTAG":
+            counts = numpy.array([self.f_returnClassHistogram()[cl] for cl in self.classes], dtype=numpy.float64)
+            return unicode(name), f_contagionIndex(self.f_returnAdjacency(1), counts / counts.sum())
+        if name == "IJI":
+            return unicode(name), f_interspersionIndex(self.f_returnAdjacency(1))
+        return HistogramAnalysis.execLandMetric(self, name, nodata)
+
+    def execSingleMetric(self, name, cl):
+        if name == unicode("Edge length"):
+            return unicode(name), self.f_returnClassEdges().get(cl, 0) * self.cellsize
+        elif name == unicode("Edge density"):
+            area = self.counts[(self.values != 0) & (self.values != self.nodata)].sum() * self.cellsize_2
+            if area == 0:
+                return unicode(name), None
+            return unicode(name), self.f_returnClassEdges().get(cl, 0) * self.cellsize / float(area)
+        return HistogramAnalysis.execSingleMetric(self, name, cl)
+
+
+# Returns the nodata value of the band, falling back to 0 if it is not usable
+def f_returnCheckedNoData(band, nodata=None):
     if nodata is None:
 
         nodata = band.GetNoDataValue()
@@ -622,23 +1931,530 @@ def LC_Initialize(raster_path, nodata=None):
         except TypeError as ex:
             logger.warn("error getting nodata {}".format(ex))
             nodata = 0
+    return nodata
+
+
+# raster_path is a file name or an opened gdal.Dataset (e.g. a VRT or an in-memory dataset).
+# backend="dask" returns a DaskLandCoverAnalysis over a lazy chunked array instead of
+# reading the whole band, for mosaics that do not fit into memory
+def LC_Initialize(raster_path, nodata=None, cache=None, compact=False, backend="numpy", chunk=2048,
+                  scheduler="threads"):
+    # raster = "extract_utm.tif"
+
+    reader = RasterBlockReader(raster_path)
+    gt = reader.geotransform
+    logger.warn(gt)
+    pixelSizeX = gt[1]
+    pixelSizeY = -gt[5]
+
+    logger.debug(pixelSizeX)
+    logger.debug(pixelSizeY)
+
+    band = reader.band
+
+    nodata = f_returnCheckedNoData(band, nodata)
+    reader.nodata = nodata
 
     # nodata = f_returnNoDataValue(raster)
-    classes, array = f_landcover(raster_path, nodata=nodata)
+    if reader.raster.RasterCount != 1:
+        logger.warn("error: Multiband Rasters not implemented yet")
+        return
 
     cellsize = pixelSizeX
     if not pixelSizeX == pixelSizeY:
         logger.debug("Warning, pixelSizeX {} and pixelSizeY {} not complete square".format(pixelSizeX, pixelSizeY))
 
-    return LandCoverAnalysis(array, cellsize, classes, nodata)
+    if backend == "dask":
+        array = reader.f_readDaskArray(chunk)
+        if array is None:
+            return None
+        return DaskLandCoverAnalysis(array, cellsize, nodata, scheduler)
+    if cache is None:
+        cache = ARRAY_CACHE
+    array = None
+    if cache:
+        try:
+            array = reader.f_readCachedArray()
+        except (IOError, OSError) as ex:
+            logger.warn("Warning, could not use the array cache {}".format(ex))
+    if array is None:
+        array = reader.f_readArray()
+    if reader.counted:
+        value_counts = reader.f_returnValueCounts()  # counted while reading
+    else:
+        values, counts = f_countValues(array)
+        value_counts = dict(zip(values.tolist(), counts.tolist()))
+    classes = sorted(v for v in value_counts if v != nodata)
+
+    analysis = LandCoverAnalysis(array, cellsize, classes, nodata, compact=compact)
+    analysis.f_setValueCounts(value_counts)
+    analysis.geotransform = gt
+    analysis.projection = reader.raster.GetProjection()
+    return analysis
+
+
+# Histogram mode, the band is only streamed block by block and never read as a whole.
+# Exact for all LC_* and diversity metrics, compact for Byte and UInt16 rasters
+def LC_InitializeHistogram(raster_path, nodata=None):
+    reader = RasterBlockReader(raster_path)
+    if reader.raster.RasterCount != 1:
+        logger.warn("error: Multiband Rasters not implemented yet")
+        return
+    reader.nodata = f_returnCheckedNoData(reader.band, nodata)
+    return reader.f_returnHistogramAnalysis()
+
+
+# Streams patch tables into one Parquet file, every f_write becomes one row group
+class PatchWriter():
+    def __init__(self, path, compression="zstd"):
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def f_write(self, records):
+        if len(records) == 0:
+            return
+        table = pyarrow.Table.from_pandas(records, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(str(self.path), table.schema, compression=self.compression)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def f_close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# Writes a label raster as UInt32 tiled, compressed GeoTIFF, block by block, and builds
+# nearest neighbour overviews
+def f_writeLabelRaster(label_path, labeled_array, geotransform, projection="", overviews=(2, 4, 8, 16), rows=1024):
+    height, width = labeled_array.shape
+    driver = gdal.GetDriverByName("GTiff")
+    out = driver.Create(str(label_path), width, height, 1, gdal.GDT_UInt32,
+                        options=["TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=2", "BIGTIFF=IF_SAFER"])
+    out.SetGeoTransform(geotransform)
+    out.SetProjection(projection)
+    out_band = out.GetRasterBand(1)
+    out_band.SetNoDataValue(0)
+    for yoff in range(0, height, rows):
+        out_band.WriteArray(labeled_array[yoff:yoff + rows].astype(numpy.uint32), 0, yoff)
+    if overviews:
+        out.BuildOverviews("NEAREST", list(overviews))
+    out_band.FlushCache()
+    out = None
+
+
+# Analysis of an array that is already in memory. The array is used as is, not copied, so
+# it can be a view into a larger mosaic. The cellsize is taken from the geotransform
+def LC_InitializeArray(array, geotransform=None, nodata=None, cellsize=None, compact=False):
+    array = numpy.asarray(array)
+    if array.ndim != 2:
+        logger.warn("error: Multiband Rasters not implemented yet")
+        return
+    if cellsize is None:
+        if geotransform is None:
+            logger.warn("error: either a geotransform or a cellsize is needed")
+            return
+        cellsize = geotransform[1]
+        if not geotransform[1] == -geotransform[5]:
+            logger.warn("Warning, pixelSizeX {} and pixelSizeY {} not complete square".format(geotransform[1], -geotransform[5]))
+    values, counts = f_countValues(array)
+    value_counts = dict(zip(values.tolist(), counts.tolist()))
+    classes = sorted(v for v in value_counts if v != nodata)
+    analysis = LandCoverAnalysis(array, cellsize, classes, nodata, compact=compact)
+    analysis.f_setValueCounts(value_counts)
+    analysis.geotransform = geotransform
+    return analysis
+
+
+# Geotransform of the pixel window starting at xoff, yoff
+def f_returnWindowGeoTransform(geotransform, xoff, yoff):
+    gt = list(geotransform)
+    gt[0] = geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2]
+    gt[3] = geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5]
+    return tuple(gt)
+
+
+# Analysis of the pixel window (xoff, yoff, xsize, ysize) of a larger array, on a view of it
+def LC_InitializeWindow(array, geotransform, window, nodata=None, compact=False):
+    xoff, yoff, xsize, ysize = window
+    view = numpy.asarray(array)[yoff:yoff + ysize, xoff:xoff + xsize]
+    return LC_InitializeArray(view, f_returnWindowGeoTransform(geotransform, xoff, yoff), nodata, compact=compact)
+
+
+# Yields (window, analysis) for consecutive size x size windows of an in-memory mosaic
+def LC_IterateWindows(array, geotransform, size=1024, nodata=None, compact=False):
+    height, width = numpy.shape(array)
+    for yoff in range(0, height, size):
+        for xoff in range(0, width, size):
+            window = (xoff, yoff, min(size, width - xoff), min(size, height - yoff))
+            yield window, LC_InitializeWindow(array, geotransform, window, nodata, compact)
+
+
+# Reopens a state written by LandCoverAnalysis.f_saveState, without the source raster.
+# Directory states are memory-mapped read-only
+def LC_LoadState(path):
+    if os.path.isdir(path):
+        state = dict((os.path.splitext(name)[0], numpy.load(os.path.join(path, name), mmap_mode="r"))
+                     for name in os.listdir(path) if name.endswith(".npy"))
+    else:
+        with numpy.load(path) as npz:
+            state = dict((name, npz[name]) for name in npz.files)
+    meta = json.loads(str(state["meta"]))
+    analysis = LandCoverAnalysis(state["array"], meta["cellsize"], state["classes"].tolist(), meta["nodata"],
+                                 compact=meta["compact"])
+    analysis.f_setValueCounts(zip(state["values"].tolist(), state["counts"].tolist()))
+    analysis.geotransform = meta.get("geotransform")
+    analysis.projection = meta.get("projection", "")
+    analysis.labeled_all = state["labeled_all"]
+    analysis.numpatches_all = meta["numpatches_all"]
+    analysis.label_class = numpy.asarray(state["label_class"])
+    columns = [name for name in ("class", "cells", "area", "perimeter", "internal_edges") if "patch_" + name in state]
+    analysis.patch_table_all = pd.DataFrame(dict((name, numpy.asarray(state["patch_" + name])) for name in columns),
+                                            index=pd.RangeIndex(1, meta["numpatches_all"] + 1, name="label"))
+    return analysis
+
+
+## Tiled labeling for rasters larger than memory
+
+# Returns the pixel windows (xoff, yoff, xsize, ysize) covering the band, aligned to its blocks
+def f_returnWindows(band, size=1024):
+    blockX, blockY = band.GetBlockSize()
+    stepX = blockX * max(1, size // blockX)
+    stepY = blockY * max(1, size // blockY)
+    windows = []
+    for yoff in range(0, band.YSize, stepY):
+        for xoff in range(0, band.XSize, stepX):
+            windows.append((xoff, yoff, min(stepX, band.XSize - xoff), min(stepY, band.YSize - yoff)))
+    return windows
+
+
+# Reads the class mask of a window with a one cell halo, cells outside the raster are False
+def f_readClassWindow(band, cl, xoff, yoff, xsize, ysize):
+    x0, y0 = max(xoff - 1, 0), max(yoff - 1, 0)
+    x1, y1 = min(xoff + xsize + 1, band.XSize), min(yoff + ysize + 1, band.YSize)
+    mask = numpy.zeros((ysize + 2, xsize + 2), dtype=bool)
+    mask[y0 - yoff + 1:y1 - yoff + 1, x0 - xoff + 1:x1 - xoff + 1] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0) == cl
+    return mask
+
+
+# Labels one window independently, returns its patch statistics and the labels along its borders
+def f_labelWindow(args):
+    raster_path, cl, (xoff, yoff, xsize, ysize), s = args
+    band = gdal.Open(str(raster_path)).GetRasterBand(1)
+    mask = f_readClassWindow(band, cl, xoff, yoff, xsize, ysize)
+    core = mask[1:-1, 1:-1]
+    labeled, numpatches = ndimage.label(core, ndimage.generate_binary_structure(2, s))
+    n = numpatches + 1
+    perimeter = numpy.zeros(n, dtype=numpy.int64)
+    internal = numpy.zeros(n, dtype=numpy.int64)
+    for neighbour in (mask[:-2, 1:-1], mask[2:, 1:-1], mask[1:-1, :-2], mask[1:-1, 2:]):
+        perimeter += numpy.bincount(labeled[core & ~neighbour], minlength=n)
+        internal += numpy.bincount(labeled[core & neighbour], minlength=n)
+    return {"numpatches": numpatches,
+            "cells": numpy.bincount(labeled.ravel(), minlength=n)[1:],
+            "perimeter": perimeter[1:],
+            "internal_edges": internal[1:],
+            "top": labeled[0, :].copy(), "bottom": labeled[-1, :].copy(),
+            "left": labeled[:, 0].copy(), "right": labeled[:, -1].copy()}
+
+
+# Labels one window again and maps its local labels to the global ones
+def f_relabelWindow(args):
+    raster_path, cl, (xoff, yoff, xsize, ysize), s, lookup = args
+    band = gdal.Open(str(raster_path)).GetRasterBand(1)
+    core = band.ReadAsArray(xoff, yoff, xsize, ysize) == cl
+    labeled, numpatches = ndimage.label(core, ndimage.generate_binary_structure(2, s))
+    return lookup[labeled]
+
+
+# Pairs of labels that touch across a seam, a and b are the facing border labels
+def f_seamPairs(a, b, s=2):
+    pairs = [(a, b)]
+    if s == 2:
+        pairs += [(a[:-1], b[1:]), (a[1:], b[:-1])]
+    u = numpy.concatenate([p[0] for p in pairs])
+    v = numpy.concatenate([p[1] for p in pairs])
+    touch = (u != 0) & (v != 0)
+    return numpy.column_stack((u[touch], v[touch]))
+
+
+# Merges labels 0..n that are linked by pairs, returns the smallest label of the merged
+# group for every label. The groups are the connected components of the pair graph
+def f_mergeLabels(pairs, n):
+    pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
+    graph = sparse.coo_matrix((numpy.ones(len(pairs), dtype=numpy.int8), (pairs[:, 0], pairs[:, 1])),
+                              shape=(n + 1, n + 1))
+    ncomponents, component = connected_components(graph.tocsr(), directed=False)
+    # labels are visited in increasing order, the first of a component is its smallest
+    components, first = numpy.unique(component, return_index=True)
+    return first[component]
+
+
+# Labels the patches of class cl window by window on a process pool and merges the labels
+# across window seams. Writes a UInt32 label raster (0 = background, overviews at the given
+# levels) and returns the patch table with globally consistent labels, optionally also
+# written as csv
+def LC_LabelTiled(raster_path, cl, label_path, table_path=None, s=2, window=1024, processes=None, overviews=None):
+    raster = gdal.Open(str(raster_path))
+    if raster.RasterCount != 1:
+        logger.warn("error: Multiband Rasters not implemented yet")
+        return
+    gt = raster.GetGeoTransform()
+    band = raster.GetRasterBand(1)
+    windows = f_returnWindows(band, window)
+    ncols = len(set(w[0] for w in windows))
+    nrows = len(windows) // ncols
+
+    # the pool is terminated if a window fails
+    with mp.Pool(processes=processes) as pool:
+        tiles = pool.map(f_labelWindow, [(raster_path, cl, w, s) for w in windows])
+
+        # provisional global labels: local label + running offset of the window
+        offsets = numpy.cumsum([0] + [t["numpatches"] for t in tiles])
+        total = int(offsets[-1])
+
+        def border(i, j, side):
+            labels = tiles[i * ncols + j][side]
+            return numpy.where(labels != 0, labels + offsets[i * ncols + j], 0)
+
+        pairs = [numpy.zeros((0, 2), dtype=numpy.int64)]
+        for i in range(nrows):
+            for j in range(ncols):
+                if j + 1 < ncols:
+                    pairs.append(f_seamPairs(border(i, j, "right"), border(i, j + 1, "left"), s))
+                if i + 1 < nrows:
+                    pairs.append(f_seamPairs(border(i, j, "bottom"), border(i + 1, j, "top"), s))
+                if s == 2 and i + 1 < nrows and j + 1 < ncols:
+                    pairs.append(f_seamPairs(border(i, j, "bottom")[-1:], border(i + 1, j + 1, "top")[:1], 1))
+                if s == 2 and i + 1 < nrows and j > 0:
+                    pairs.append(f_seamPairs(border(i, j, "bottom")[:1], border(i + 1, j - 1, "top")[-1:], 1))
+        roots = f_mergeLabels(numpy.concatenate(pairs), total)
+        labels, lookup = numpy.unique(roots, return_inverse=True)  # root 0 is the background
+        lookup = lookup.astype(numpy.uint32)
+        numpatches = len(labels) - 1
+
+        # the patch table sums the window statistics per global label
+        table = {}
+        for col in ("cells", "perimeter", "internal_edges"):
+            values = numpy.concatenate([t[col] for t in tiles])
+            table[col] = numpy.bincount(lookup[1:], weights=values, minlength=numpatches + 1)[1:].astype(numpy.int64)
+        table = pd.DataFrame({"cells": table["cells"],
+                              "area": table["cells"] * math.pow(gt[1], 2),
+                              "perimeter": table["perimeter"],
+                              "internal_edges": table["internal_edges"]},
+                             index=pd.RangeIndex(1, numpatches + 1, name="label"))
+
+        driver = gdal.GetDriverByName("GTiff")
+        out = driver.Create(str(label_path), band.XSize, band.YSize, 1, gdal.GDT_UInt32,
+                            options=["TILED=YES", "COMPRESS=LZW", "BIGTIFF=IF_SAFER"])
+        out.SetGeoTransform(gt)
+        out.SetProjection(raster.GetProjection())
+        out_band = out.GetRasterBand(1)
+        out_band.SetNoDataValue(0)
+        args = []
+        for k, w in enumerate(windows):
+            window_lookup = lookup[offsets[k]:offsets[k + 1] + 1].copy()
+            window_lookup[0] = 0  # local background
+            args.append((raster_path, cl, w, s, window_lookup))
+        for w, labeled in zip(windows, pool.imap(f_relabelWindow, args)):
+            out_band.WriteArray(labeled, w[0], w[1])
+    if overviews:
+        out.BuildOverviews("NEAREST", list(overviews))
+    out_band.FlushCache()
+    out = None
+
+    if table_path is not None:
+        table.to_csv(table_path, sep=';')
+    return table
+
+
+## Batched analysis of many equal shaped tiles
+
+# Class metrics that f_returnStackMetrics computes for all tiles of a stack at once
+STACK_METRICS = ["Land cover", "Landscape Proportion", "Edge length", "Edge density", "Number of Patches",
+                 "Patch density", "Greatest patch area", "Smallest patch area", "Mean patch area",
+                 "Median patch area", "Largest Patch Index", "Fractal Dimension Index", "Mean patch shape ratio",
+                 "Mean Shape Index", "Like adjacencies", "Patch cohesion index", "Landscape division",
+                 "Splitting Index", "Effective Meshsize"]
+
+
+# Labels the masks of a stack of tiles (tiles x rows x cols) in one ndimage.label call. The
+# structure has no connectivity along the stack axis, so labels never cross tiles and are
+# numbered tile by tile. Returns the labels, numpatches and the tile of every label
+def f_labelStack(masks, s=2):
+    struct = numpy.zeros((3, 3, 3), dtype=bool)
+    struct[1] = ndimage.generate_binary_structure(2, s)
+    labeled, numpatches = ndimage.label(masks, struct)
+    ends = numpy.maximum.accumulate(labeled.reshape(len(labeled), -1).max(axis=1))
+    tile_of_label = numpy.searchsorted(ends, numpy.arange(numpatches + 1))
+    return labeled, numpatches, tile_of_label
+
+
+# Patch table of a labeled stack indexed by (tile, label), labels numbered 1.. in every tile.
+# One bincount over the stack labels is the grouped count over (tile, label)
+def f_returnStackPatchTable(labeled, numpatches, tile_of_label, cellsize):
+    n = numpatches + 1
+    cells = numpy.bincount(labeled.ravel(), minlength=n)
+    perimeter, internal = f_edgeCounts(labeled, numpatches)
+    tile = tile_of_label[1:]
+    first = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(tile)) + 1))
+    local = numpy.arange(numpatches) - numpy.repeat(first, numpy.diff(numpy.concatenate((first, [numpatches])))) + 1
+    table = pd.DataFrame({"tile": tile,
+                          "label": local,
+                          "cells": cells[1:],
+                          "area": cells[1:] * math.pow(cellsize, 2),
+                          "perimeter": perimeter[1:],
+                          "internal_edges": internal[1:]})
+    return table.set_index(["tile", "label"])
+
+
+# Class metrics of every tile from a stack patch table, with the formulas of the
+# LandCoverAnalysis methods. landscape_cells are the cells of the tile that are neither 0 nor
+# nodata, total_cells the non-zero cells and tile_cells the size of a tile
+def f_returnStackMetrics(table, ntiles, landscape_cells, total_cells, tile_cells, cellsize, metrics):
+    cellsize_2 = math.pow(cellsize, 2)
+    t = table.reset_index()
+    cells = t["cells"].values.astype(float)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        t["cells2"] = cells * cells
+        t["frac"] = 2.0 * numpy.log(0.25 * t["perimeter"].values * float(cellsize)) / numpy.log(t["area"].values)
+        t["ratio"] = t["perimeter"].values / cells
+        t["shape"] = 0.25 * t["perimeter"].values / numpy.sqrt(cells)
+        t["cohesion"] = t["internal_edges"].values * numpy.sqrt(cells)
+    agg = t.groupby("tile").agg(n=("label", "size"), cells=("cells", "sum"), cells2=("cells2", "sum"),
+                                amax=("area", "max"), amin=("area", "min"), amean=("area", "mean"),
+                                amedian=("area", "median"), perimeter=("perimeter", "sum"),
+                                internal=("internal_edges", "sum"), frac=("frac", "mean"), ratio=("ratio", "mean"),
+                                shape=("shape", "mean"), cohesion=("cohesion", "sum"))
+    agg = agg.reindex(pd.RangeIndex(ntiles, name="tile"))
+    n = agg["n"].fillna(0).values
+    class_cells = agg["cells"].fillna(0).values
+    lcells = numpy.asarray(landscape_cells, dtype=float)
+    larea = lcells * cellsize_2
+    area2 = agg["cells2"].fillna(0).values * cellsize_2 * cellsize_2
+    edges = agg["perimeter"].fillna(0).values
+    internal = agg["internal"].fillna(0).values
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        values = {"Land cover": class_cells * cellsize_2,
+                  "Landscape Proportion": class_cells / numpy.asarray(total_cells, dtype=float),
+                  "Edge length": edges * cellsize,
+                  "Edge density": edges * cellsize / larea,
+                  "Number of Patches": n,
+                  "Patch density": n / larea,
+                  "Greatest patch area": agg["amax"].values,
+                  "Smallest patch area": agg["amin"].values,
+                  "Mean patch area": agg["amean"].values,
+                  "Median patch area": agg["amedian"].values,
+                  "Largest Patch Index": agg["amax"].values / larea * 100,
+                  "Fractal Dimension Index": agg["frac"].values,
+                  "Mean patch shape ratio": agg["ratio"].values,
+                  "Mean Shape Index": agg["shape"].values,
+                  "Like adjacencies": internal / (internal + edges * 2),
+                  "Patch cohesion index": ((1 - internal / agg["cohesion"].values) *
+                                           ((1 - 1 / numpy.sqrt(tile_cells)) / 10)) * 100,
+                  "Landscape division": 1 - area2 / (larea * larea),
+                  "Splitting Index": larea * larea / area2,
+                  "Effective Meshsize": area2 / larea}
+    res = pd.DataFrame(dict((name, values[name]) for name in metrics), index=agg.index)
+    return res.replace([numpy.inf, -numpy.inf], numpy.nan)
+
+
+# Class metrics of class cl for every tile of a stack (tiles x rows x cols) of equal shaped
+# tiles. The tiles are labeled in one call and the STACK_METRICS come from one grouped patch
+# table, other metrics fall back to a LandCoverAnalysis per tile. Returns one row per tile
+def LC_AnalyseStack(stack, cl, cellsize, metrics, nodata=None, s=2):
+    stack = numpy.asarray(stack)
+    ntiles = len(stack)
+    labeled, numpatches, tile_of_label = f_labelStack(stack == cl, s)
+    table = f_returnStackPatchTable(labeled, numpatches, tile_of_label, cellsize)
+    nonzero = stack != 0
+    total_cells = nonzero.sum(axis=(1, 2))
+    landscape_cells = total_cells if nodata is None else (nonzero & (stack != nodata)).sum(axis=(1, 2))
+    batched = [name for name in metrics if name in STACK_METRICS]
+    res = f_returnStackMetrics(table, ntiles, landscape_cells, total_cells, stack[0].size, cellsize, batched)
+    others = [name for name in metrics if name not in STACK_METRICS]
+    for k in range(ntiles) if others else []:
+        analysis = LC_InitializeArray(stack[k], nodata=nodata, cellsize=cellsize)
+        for name, value in zip(*[compute_metrics(analysis, others, [cl])[c] for c in ("metric", "value")]):
+            res.at[k, name] = value
+    return res[metrics]
+
+
+# Groups the tiles by shape, data type, cellsize and nodata from their metadata, then reads
+# and analyses each group in stacks of up to batch tiles with LC_AnalyseStack, so only one
+# stack is in memory at a time. Returns one row per tile, indexed by tile_ids (default the paths)
+def LC_AnalyseTiles(raster_paths, cl, metrics, nodata=None, s=2, batch=256, tile_ids=None):
+    tile_ids = list(raster_paths) if tile_ids is None else list(tile_ids)
+    groups = {}
+    for tile_id, path in zip(tile_ids, raster_paths):
+        raster = gdal.Open(str(path))
+        band = raster.GetRasterBand(1)
+        tile_nodata = band.GetNoDataValue() if nodata is None else nodata
+        key = ((raster.RasterYSize, raster.RasterXSize), band.DataType, raster.GetGeoTransform()[1], tile_nodata)
+        groups.setdefault(key, []).append((tile_id, path))
+    results = []
+    for (shape, datatype, cellsize, tile_nodata), tiles in groups.items():
+        for start in range(0, len(tiles), batch):
+            part = tiles[start:start + batch]
+            stack = numpy.stack([gdal.Open(str(path)).GetRasterBand(1).ReadAsArray() for tile_id, path in part])
+            res = LC_AnalyseStack(stack, cl, cellsize, metrics, tile_nodata, s)
+            stack = None
+            res.index = pd.Index([tile_id for tile_id, path in part], name="tile_id")
+            results.append(res)
+    if not results:
+        return pd.DataFrame(columns=metrics)
+    return pd.concat(results).reindex(tile_ids)
+
+
+# Evaluates several class metrics for several classes, computing every intermediate they
+# declare in SINGLE_METRICS only once. Classes are evaluated on per-class contexts, with
+# threads > 1 on a thread pool (labeling and most reductions release the GIL).
+# Returns a tidy DataFrame with columns class, metric, value
+def compute_metrics(landcover_object, metrics, classes=None, threads=1):
+    if classes is None:
+        classes = landcover_object.classes
+    for name in metrics:
+        if name not in SINGLE_METRICS:
+            logger.warn("error: unknown metric {}".format(name))
+    metrics = [name for name in metrics if name in SINGLE_METRICS]
+    needs = set()
+    for name in metrics:
+        needs.update(SINGLE_METRICS[name][0])
+
+    # shared intermediates are evaluated before any class runs
+    if "landscape_counts" in needs:
+        landcover_object.f_returnClassHistogram()
+    if "landscape_area" in needs:
+        landcover_object.f_LandscapeArea()
+    if "adjacency" in needs:
+        landcover_object.f_returnAdjacencyMetrics()
+    if "labels" in needs and len(classes) > 1 and landcover_object.labeled_all is None:
+        landcover_object.f_cclAll()
+
+    def evaluate(cl):
+        if "labels" in needs:
+            context = landcover_object.f_classContext(cl)
+        else:
+            context = copy.copy(landcover_object)
+            context.cl = cl
+        if "patch_table" in needs:
+            context.f_returnPatchTable(context.labeled_array, context.numpatches)
+        return [(cl, unicode(name), SINGLE_METRICS[name][1](context, cl)) for name in metrics]
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(evaluate, classes))
+    else:
+        results = [evaluate(cl) for cl in classes]
+    rows = [row for class_rows in results for row in class_rows]
+    return pd.DataFrame(rows, columns=["class", "metric", "value"])
 
 
 def compute_simple_statistics(landcover_object):
-    simple_mt = []
+    simple_mt = landcover_object.execLandMetrics(list_simple_metrics(), landcover_object.nodata)
 
-    for smt in list_simple_metrics():
-        lb = landcover_object.execLandMetric(smt, landcover_object.nodata)
-        simple_mt.append(lb)
+    for lb in simple_mt:
         logger.warn(lb)
 
     # massaging to nice data frame for csv export
@@ -9,7 +9,7 @@ import multiprocessing as mp
 from subprocess import Popen, PIPE, call
 import fiona  # type: ignore
 
-from lcmodel_typed import LC_Initialize, compute_simple_statistics
+from lcmodel_typed import LC_Initialize, compute_simple_statistics, compute_metrics
 import pandas as pd  # type: ignore
 import numpy as np  # type: ignore
 
@@ -76,17 +76,14 @@ def calculate_for_feature(featureid: str, cli: int) -> Dict:
     results_dict['tile_id'] = featureid
 
     try:
-        lc_calc = LC_Initialize(raster)
+        lc_calc = LC_Initialize(raster, compact=True)
 
         # if completely empty then just skip
         if cli in lc_calc.classes:
 
-            lc_calc.create_cl_array_for_class(cli)
-            lc_calc.f_ccl(lc_calc.cl_array)
-
-            for smt in single_metrics:
-                met_tup = lc_calc.execSingleMetric(smt, cli)
-                results_dict[smt] = met_tup[1]
+            metrics_df = compute_metrics(lc_calc, single_metrics, [cli])
+            for smt, smt_val in zip(metrics_df['metric'], metrics_df['value']):
+                results_dict[smt] = smt_val
 
         else:
 
@@ -111,12 +108,11 @@ def calculate_land_metric(featureid: str) -> Dict:
     results_dict['tile_id'] = featureid
 
     try:
-        lc_calc = LC_Initialize(raster)
+        lc_calc = LC_Initialize(raster, compact=True)
 
         # landmetrics overall classes
-        for lmt in land_metrics:
-            lmt_met_tup = lc_calc.execLandMetric(lmt, lc_calc.nodata)
-            results_dict[lmt] = lmt_met_tup[1]
+        for lmt, lmt_val in lc_calc.execLandMetrics(land_metrics, lc_calc.nodata):
+            results_dict[lmt] = lmt_val
 
     except Exception as ex:
         logger.error(ex)
@@ -76,7 +76,7 @@ def calculate_for_feature(featureid: str) -> Dict:
     results_dict['tile_id'] = featureid
 
     try:
-        lc_calc = LC_Initialize(raster)
+        lc_calc = LC_Initialize(raster, compact=True)
 
         lc_calc.create_cl_array_for_class(None)
         lc_calc.f_ccl(lc_calc.cl_array)
@@ -9,7 +9,7 @@ import multiprocessing as mp
 from subprocess import Popen, PIPE, call
 import fiona  # type: ignore
 
-from lcmodel_typed import LC_Initialize, compute_simple_statistics
+from lcmodel_typed import LC_Initialize, compute_simple_statistics, compute_metrics
 import pandas as pd # type: ignore
 import numpy as np # type: ignore
 
@@ -35,13 +35,15 @@ fh.setFormatter(formatter)
 logger.addHandler(fh)
 
 # these are class/year based
-# 'Euclidean Nearest-Neighbor Distance',
 single_metrics = ['Edge density',
                   'Mean patch area',
                   'Median patch area',
+                  'Euclidean Nearest-Neighbor Distance',
                   'Like adjacencies',
                   'Overall Core area',
-                  'Patch cohesion index']
+                  'Patch cohesion index',
+                  'Edge influence',
+                  'Mean distance to edge']
 
 # these are landscape based without class
 land_metrics = ["LC_Mean",
@@ -80,21 +82,17 @@ def calculate_for_feature(featureid: str, year: int) -> Dict:
 
         # all raster have only one class "2"
         cli=2
-        lc_calc = LC_Initialize(raster)
+        lc_calc = LC_Initialize(raster, compact=True)
 
         # if completely empty then just skip
         if cli in lc_calc.classes:
 
-            for lmt in land_metrics:
-                lmt_met_tup = lc_calc.execLandMetric(lmt, lc_calc.nodata)
-                results_dict[lmt] = lmt_met_tup[1]
+            for lmt, lmt_val in lc_calc.execLandMetrics(land_metrics, lc_calc.nodata):
+                results_dict[lmt] = lmt_val
 
-            lc_calc.create_cl_array_for_class(cli)
-            lc_calc.f_ccl(lc_calc.cl_array)
-
-            for smt in single_metrics:
-                smt_met_tup = lc_calc.execSingleMetric(smt, cli)
-                results_dict[smt] = smt_met_tup[1]
+            metrics_df = compute_metrics(lc_calc, single_metrics, [cli])
+            for smt, smt_val in zip(metrics_df['metric'], metrics_df['value']):
+                results_dict[smt] = smt_val
 
         else:
 